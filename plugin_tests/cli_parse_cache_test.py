@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import os
+import shutil
+import stat
+import tempfile
+
+from tests import base
+
+
+# boiler plate to start and stop the server
+def setUpModule():
+    base.enabledPlugins.append('slicer_cli_web_ssr')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class CLIParseCacheTest(base.TestCase):
+
+    def setUp(self):
+        base.TestCase.setUp(self)
+        from girder.plugins.slicer_cli_web_ssr import cli_parse_cache, \
+            rest_slicer_cli
+
+        self.cli_parse_cache = cli_parse_cache
+        self.CLIParseCache = cli_parse_cache.CLIParseCache
+        self.tempdir = tempfile.mkdtemp()
+        self.parsed = []
+
+        def parse(xml):
+            self.parsed.append(xml)
+            return rest_slicer_cli._parseCLIXML(xml)
+
+        self.parse = parse
+        path = os.path.join(os.path.dirname(__file__), 'data',
+                            'SparseColorDeconvolution.xml')
+        with open(path) as f:
+            self.xml = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        base.TestCase.tearDown(self)
+
+    def notCalled(self, *args):
+        self.fail('The spec should not have been loaded or parsed')
+
+    def testParseMany(self):
+        # the specs that are not cached are parsed, and a bad spec does not
+        # stop the others
+        cache = self.CLIParseCache()
+        specs = {'good': self.xml, 'other': self.xml, 'bad': 'not an xml spec'}
+        self.assertEqual(cache.parseMany(specs, self.parse), 3)
+        self.assertIn('good', cache)
+        self.assertIn('other', cache)
+        self.assertNotIn('bad', cache)
+        clim = cache.get('good', self.notCalled, self.notCalled)[0]
+        self.assertEqual(clim.title, 'Performs Adaptive Color Deconvolution')
+        # only the bad spec is parsed again
+        del self.parsed[:]
+        self.assertEqual(cache.parseMany(specs, self.parse), 1)
+        self.assertEqual(self.parsed, ['not an xml spec'])
+
+    def testGet(self):
+        # results are cached by content hash
+        cache = self.CLIParseCache()
+        result = cache.get('hash1', lambda: self.xml, self.parse)
+        self.assertEqual(len(self.parsed), 1)
+        self.assertIs(cache.get('hash1', self.notCalled, self.notCalled),
+                      result)
+        cache.get('hash2', lambda: self.xml, self.parse)
+        self.assertEqual(len(self.parsed), 2)
+        cache.put('hash3', 'result')
+        self.assertEqual(cache.get('hash3', self.notCalled, self.notCalled),
+                         'result')
+        with self.assertRaises(Exception):
+            cache.get('hash4', lambda: 'not an xml spec', self.parse)
+        self.assertNotIn('hash4', cache)
+
+    def testCorruptFile(self):
+        # a cache file that cannot be read is ignored and replaced
+        cache = self.CLIParseCache(self.tempdir)
+        with open(cache._path('hash1'), 'wb') as f:
+            f.write(b'not a pickle')
+        result = cache.get('hash1', lambda: self.xml, self.parse)
+        self.assertEqual(len(self.parsed), 1)
+        cache = self.CLIParseCache(self.tempdir)
+        self.assertEqual(
+            cache.get('hash1', self.notCalled, self.notCalled)[0].title,
+            result[0].title)
+
+    def testDirectoryPermissions(self):
+        # a missing directory is created so that only girder can access it
+        directory = os.path.join(self.tempdir, 'cache')
+        cache = self.CLIParseCache(directory)
+        self.assertEqual(cache.directory, directory)
+        self.assertEqual(stat.S_IMODE(os.stat(directory).st_mode) & 0o077, 0)
+        # a directory others can write to is not used
+        os.chmod(directory, 0o777)
+        cache = self.CLIParseCache(directory)
+        self.assertIsNone(cache.directory)
+        cache.get('hash1', lambda: self.xml, self.parse)
+        self.assertEqual(os.listdir(directory), [])
+
+    def testResultVersion(self):
+        # results from another parser or format version are not loaded
+        cache = self.CLIParseCache(self.tempdir)
+        cache.get('hash1', lambda: self.xml, self.parse)
+        cache = self.CLIParseCache(self.tempdir)
+        cache._suffix = '-other.pickle'
+        cache.get('hash1', lambda: self.xml, self.parse)
+        self.assertEqual(len(self.parsed), 2)
+
+    def testCacheDirSetting(self):
+        # parse results persist in the directory from the setting
+        from girder.plugins.slicer_cli_web_ssr.constants import PluginSettings
+
+        self.model('setting').set(PluginSettings.CLI_PARSE_CACHE_DIR,
+                                  self.tempdir)
+        try:
+            self.cli_parse_cache._cache = None
+            cache = self.cli_parse_cache.getCLIParseCache()
+            self.assertEqual(cache.directory, self.tempdir)
+            result = cache.get('hash1', lambda: self.xml, self.parse)
+            self.assertEqual(os.listdir(self.tempdir),
+                             [os.path.basename(cache._path('hash1'))])
+            self.cli_parse_cache._cache = None
+            cache = self.cli_parse_cache.getCLIParseCache()
+            loaded = cache.get('hash1', self.notCalled, self.notCalled)
+            self.assertEqual(loaded[0].title, result[0].title)
+            self.assertEqual(len(self.parsed), 1)
+        finally:
+            self.model('setting').unset(PluginSettings.CLI_PARSE_CACHE_DIR)
+            self.cli_parse_cache._cache = None
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import docker
+
+from tests import base
+
+
+# boiler plate to start and stop the server
+def setUpModule():
+    base.enabledPlugins.append('slicer_cli_web_ssr')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class StubImage(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class StubClient(object):
+    """
+    A docker client with a fixed image list, which records the images it is
+    asked for one at a time.
+    """
+
+    def __init__(self, images, others=None):
+        self.listed = images
+        self.others = others or {}
+        self.requested = []
+        self.api = self
+        self.images = self
+
+    def get(self, name):
+        self.requested.append(name)
+        if name not in self.others:
+            raise docker.errors.ImageNotFound(name)
+        return StubImage(self.others[name])
+
+    # docker.APIClient.images
+    def __call__(self):
+        return self.listed
+
+
+class LocalImageIndexTest(base.TestCase):
+
+    def testGetImageId(self):
+        from girder.plugins.slicer_cli_web_ssr.docker_client import \
+            LocalImageIndex
+
+        client = StubClient([{
+            'Id': 'sha256:abcdef0123',
+            'RepoTags': ['dsarchive/histomicstk:latest',
+                         'myregistry:5000/algo:latest'],
+            'RepoDigests': None,
+        }, {
+            'Id': 'sha256:abc9876543',
+            'RepoTags': ['ubuntu:16.04'],
+            'RepoDigests': ['ubuntu@sha256:1234'],
+        }], {'other/image:1': 'sha256:fedcba'})
+        index = LocalImageIndex(client)
+        for (name, imageId) in (
+                ('dsarchive/histomicstk', 'sha256:abcdef0123'),
+                ('dsarchive/histomicstk:latest', 'sha256:abcdef0123'),
+                ('myregistry:5000/algo', 'sha256:abcdef0123'),
+                ('docker.io/library/ubuntu:16.04', 'sha256:abc9876543'),
+                ('ubuntu@sha256:1234', 'sha256:abc9876543'),
+                ('sha256:abc9876543', 'sha256:abc9876543'),
+                ('abcdef', 'sha256:abcdef0123'),
+                ('other/image:1', 'sha256:fedcba'),
+                ('ubuntu:14.04', None),
+                # an ambiguous id prefix
+                ('abc', None)):
+            self.assertEqual(index.getImageId(name), imageId)
+        self.assertFalse(index.exists('ubuntu:14.04'))
+        # only names the snapshot did not resolve were looked up, once each
+        self.assertEqual(client.requested,
+                         ['other/image:1', 'ubuntu:14.04', 'abc'])
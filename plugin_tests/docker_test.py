@@ -17,10 +17,13 @@
 #  limitations under the License.
 ###############################################################################
 
+import cherrypy
+import datetime
 import docker
 import json
 import six
 import threading
+import time
 import types
 
 from tests import base
@@ -103,6 +106,93 @@ class DockerImageManagementTest(base.TestCase):
         self.addImage([img_name], JobStatus.SUCCESS)
         self.imageIsLoaded(img_name, True)
 
+    def testDockerAddMixedList(self):
+        # a bad image in the list fails the job, but the good images are
+        # still cached
+        img_name = 'girder/slicer_cli_web:small'
+        self.assertNoImages()
+        self.addImage([img_name, 'null/null:null'], JobStatus.ERROR)
+        self.imageIsLoaded(img_name, True)
+
+    def testDockerAddAlias(self):
+        # a second tag of an ingested image reuses its metadata
+        img_name = 'girder/slicer_cli_web:small'
+        alias_name = 'girder/slicer_cli_web:small-alias'
+        self.assertNoImages()
+        self.addImage(img_name, JobStatus.SUCCESS)
+        docker_client = docker.from_env(version='auto')
+        docker_client.images.get(img_name).tag('girder/slicer_cli_web',
+                                               'small-alias')
+        try:
+            self.addImage(alias_name, JobStatus.SUCCESS)
+            self.imageIsLoaded(alias_name, True)
+            self.endpointsExist(alias_name, ['Example1', 'Example2'],
+                                ['Example3'])
+            job = self.model('job', 'jobs').findOne(
+                {'type': 'slicer_cli_web_ssr_job'}, sort=[('created', -1)])
+            self.assertIn('Reused image %s cli metadata' % alias_name,
+                          ''.join(job['log']))
+        finally:
+            self.deleteImage(alias_name, True)
+            docker_client.images.remove(alias_name)
+
+    def testDockerAddCoalesced(self):
+        # adding an image that an unfinished job is ingesting returns that job
+        img_name = 'girder/slicer_cli_web:small'
+        self.assertNoImages()
+        jobModel = self.model('job', 'jobs')
+        job = jobModel.createLocalJob(
+            module='girder.plugins.slicer_cli_web_ssr.image_job',
+            function='jobPullAndLoad',
+            kwargs={'pullList': [img_name], 'loadList': [img_name]},
+            title='Pulling and caching docker images ',
+            type='slicer_cli_web_ssr_job', user=self.admin, public=True)
+        try:
+            resp = self.request(
+                path='/slicer_cli_web_ssr/slicer_cli_web_ssr/docker_image',
+                user=self.admin, method='PUT',
+                params={'name': json.dumps(img_name)})
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.json['_id'], str(job['_id']))
+        finally:
+            jobModel.remove(job)
+        self.assertNoImages()
+
+    def testDockerAddStaleJob(self):
+        # an unfinished job that has not been updated for a long time, e.g.,
+        # because its girder process died, is not joined
+        img_name = 'girder/slicer_cli_web:small'
+        self.assertNoImages()
+        jobModel = self.model('job', 'jobs')
+        job = jobModel.createLocalJob(
+            module='girder.plugins.slicer_cli_web_ssr.image_job',
+            function='jobPullAndLoad',
+            kwargs={'pullList': [img_name], 'loadList': [img_name]},
+            title='Pulling and caching docker images ',
+            type='slicer_cli_web_ssr_job', user=self.admin, public=True)
+        jobModel.update({'_id': job['_id']}, {'$set': {
+            'status': JobStatus.RUNNING,
+            'updated': datetime.datetime.utcnow() - datetime.timedelta(
+                days=1)}})
+        try:
+            self.addImage(img_name, JobStatus.SUCCESS)
+            self.imageIsLoaded(img_name, True)
+            latest = jobModel.findOne({'type': 'slicer_cli_web_ssr_job'},
+                                      sort=[('created', -1)])
+            self.assertNotEqual(latest['_id'], job['_id'])
+        finally:
+            jobModel.remove(job)
+
+    def testDockerRefresh(self):
+        # refreshing an image whose tag did not move re-extracts nothing
+        img_name = 'girder/slicer_cli_web:small'
+        self.assertNoImages()
+        self.addImage(img_name, JobStatus.SUCCESS)
+        job = self.refreshImages(img_name, JobStatus.SUCCESS)
+        self.assertIn('0 of 1 images changed', ''.join(job['log']))
+        self.imageIsLoaded(img_name, True)
+        self.endpointsExist(img_name, ['Example1', 'Example2'], ['Example3'])
+
     def testDockerAddWithoutVersion(self):
         # all images need a version or hash
         img_name = 'girder/slicer_cli_web'
@@ -157,6 +247,20 @@ class DockerImageManagementTest(base.TestCase):
         self.assertNoImages()
         self.deleteImage(img_name, False, )
 
+    def testMixedImageDelete(self):
+        # deleting a list with an unknown image still removes the known one
+        img_name = 'girder/slicer_cli_web:small'
+        self.assertNoImages()
+        self.addImage(img_name, JobStatus.SUCCESS)
+        resp = self.request(
+            path='/slicer_cli_web_ssr/slicer_cli_web_ssr/docker_image',
+            user=self.admin, method='DELETE',
+            params={'name': json.dumps([img_name, 'null/null:null'])})
+        self.assertStatus(resp, 400)
+        self.assertIn('null/null:null', resp.json['message'])
+        self.imageIsLoaded(img_name, exists=False)
+        self.assertNoImages()
+
     def testXmlEndpoint(self):
         # loads an image and attempts to run an arbitrary xml endpoint
 
@@ -178,6 +282,58 @@ class DockerImageManagementTest(base.TestCase):
                     # TODO validate with xml schema
                     self.assertNotEqual(xmlString, '')
 
+    def testXmlStoredSeparately(self):
+        # image documents only reference the cli xml specs, which are removed
+        # with the last image that uses them
+        img_name = 'girder/slicer_cli_web:small'
+        self.assertNoImages()
+        self.addImage(img_name, JobStatus.SUCCESS)
+        doc = self.model('docker_image_model', 'slicer_cli_web_ssr').findOne()
+        for cli in six.itervalues(doc['cli_list']):
+            self.assertNotIn('xml', cli)
+            self.assertIn('xmlhash', cli)
+        specModel = self.model('cli_xml_spec', 'slicer_cli_web_ssr')
+        self.assertEqual(specModel.find().count(), len(doc['xml_hashes']))
+        for spec in specModel.find():
+            self.assertEqual(spec['compression'], 'zlib')
+        self.testXmlEndpoint()
+        self.deleteImage(img_name, True)
+        # specs referenced within the grace period are kept
+        self.assertEqual(specModel.find().count(), len(doc['xml_hashes']))
+        specModel.removeUnreferenced(gracePeriod=datetime.timedelta(0))
+        self.assertEqual(specModel.find().count(), 0)
+
+    def testXmlKeptForAliasBeingAdded(self):
+        # deleting a tag while another tag of the same image id is being
+        # added keeps the specs the new tag references
+        img_name = 'girder/slicer_cli_web:small'
+        alias_name = 'girder/slicer_cli_web:small-alias'
+        self.assertNoImages()
+        self.addImage(img_name, JobStatus.SUCCESS)
+        from girder.plugins.slicer_cli_web_ssr.models import DockerImage
+
+        imageModel = self.model('docker_image_model', 'slicer_cli_web_ssr')
+        specModel = self.model('cli_xml_spec', 'slicer_cli_web_ssr')
+        doc = imageModel.findOne({DockerImage.imageName: img_name})
+        alias = {key: val for (key, val) in six.iteritems(doc)
+                 if key != '_id'}
+        alias[DockerImage.imageName] = alias_name
+        alias[DockerImage.imageHash] = DockerImage.getHashKey(alias_name)
+        # the alias job reuses the cli data, which holds only the spec
+        # hashes, and marks its specs as referenced before it writes them
+        alias = imageModel._externalizeXML([alias])[0]
+        self.deleteImage(img_name, True)
+        specModel.removeUnreferenced()
+        self.assertEqual(specModel.find().count(), len(doc['xml_hashes']))
+        imageModel._writeImages([alias])
+        try:
+            for xmlHash in doc['xml_hashes']:
+                self.assertNotEqual(specModel.getXML(xmlHash), '')
+        finally:
+            imageModel.removeImages([alias_name])
+        specModel.removeUnreferenced(gracePeriod=datetime.timedelta(0))
+        self.assertEqual(specModel.find().count(), 0)
+
     def testEndpointDeletion(self):
         img_name = 'girder/slicer_cli_web:small'
         self.testXmlEndpoint()
@@ -196,6 +352,186 @@ class DockerImageManagementTest(base.TestCase):
                     # xml route should have been deleted
                     self.assertStatus(resp, 400)
 
+    def testEndpointSync(self):
+        # endpoints follow metadata removed without going through this
+        # resource, as another girder process would
+        img_name = 'girder/slicer_cli_web:small'
+        self.testXmlEndpoint()
+        data = self.getEndpoint()
+        self.model('docker_image_model', 'slicer_cli_web_ssr').removeImages(
+            [img_name])
+        routes = [info['xmlspec']
+                  for tag in six.itervalues(data)
+                  for cli in six.itervalues(tag)
+                  for info in six.itervalues(cli)]
+        self.assertTrue(routes)
+        for _ in range(TIMEOUT):
+            resp = self.request(path=routes[0], user=self.admin, isJson=False)
+            if resp.output_status.startswith(b'400'):
+                break
+            time.sleep(1)
+        for route in routes:
+            resp = self.request(path=route, user=self.admin, isJson=False)
+            self.assertStatus(resp, 400)
+
+    def testStagedEndpoints(self):
+        # other threads keep using the published endpoints while they are
+        # changed, and a failed change publishes nothing
+        img_name = 'girder/slicer_cli_web:small'
+        self.testXmlEndpoint()
+        resource = self.getResource()
+        route = self.getEndpoint()['girder/slicer_cli_web']['small'][
+            'Example1']['xmlspec']
+        routes = resource._routes
+        seen = []
+
+        def serve():
+            seen.append((resource._routes, img_name in
+                         resource.currentEndpoints))
+            seen.append(self.request(path=route, user=self.admin,
+                                     isJson=False))
+
+        with self.assertRaises(ValueError):
+            with resource._stagedEndpoints():
+                resource.deleteImageEndpoints([img_name])
+                self.assertNotIn(img_name, resource.currentEndpoints)
+                thread = threading.Thread(target=serve)
+                thread.start()
+                thread.join()
+                raise ValueError('failed while changing the endpoints')
+        self.assertIs(seen[0][0], routes)
+        self.assertTrue(seen[0][1])
+        self.assertStatus(seen[1], 200)
+        self.assertIs(resource._routes, routes)
+        self.assertIn(img_name, resource.endpointRevisions)
+        self.endpointsExist(img_name, ['Example1', 'Example2'], ['Example3'])
+
+        with resource._stagedEndpoints():
+            resource.deleteImageEndpoints([img_name])
+            thread = threading.Thread(target=serve)
+            thread.start()
+            thread.join()
+        self.assertIs(seen[2][0], routes)
+        self.assertStatus(seen[3], 200)
+        self.assertIsNot(resource._routes, routes)
+        resp = self.request(path=route, user=self.admin, isJson=False)
+        self.assertStatus(resp, 400)
+        self.deleteImage(img_name, True)
+
+    def testReconcile(self):
+        # registered images that are no longer local are removed and those
+        # whose tag moved are refreshed once, by one girder process
+        from girder.plugins.slicer_cli_web_ssr import reconciler
+
+        img_name = 'girder/slicer_cli_web:small'
+        self.assertNoImages()
+        self.addImage(img_name, JobStatus.SUCCESS)
+        imageModel = self.model('docker_image_model', 'slicer_cli_web_ssr')
+        jobModel = self.model('job', 'jobs')
+        # the images the index resolves, and those only images.get resolves
+        localImages = {img_name: 'sha256:moved'}
+        otherImages = {}
+        refreshed = []
+
+        class StubImageIndex(object):
+            def __init__(self, client):
+                pass
+
+            def getImageId(self, name):
+                return localImages.get(name)
+
+        class StubImage(object):
+            def __init__(self, id):
+                self.id = id
+
+        class StubClient(object):
+            def __init__(self):
+                self.images = self
+
+            def get(self, name):
+                if name not in otherImages:
+                    raise docker.errors.ImageNotFound(name)
+                return StubImage(otherImages[name])
+
+        realImageIndex = reconciler.LocalImageIndex
+        realGetDockerClient = reconciler.getDockerClient
+        reconciler.LocalImageIndex = StubImageIndex
+        reconciler.getDockerClient = StubClient
+        imageModel.refreshImages = lambda names, jobType, pull=False: (
+            refreshed.extend(names))
+        try:
+            rec = reconciler.DockerImageReconciler(self.getResource(), 300)
+            self.assertTrue(imageModel.acquireLease(
+                'reconciler', 'other', datetime.timedelta(minutes=5)))
+            self.assertEqual(rec.reconcile(), ([], []))
+            imageModel.database['docker_image_model_registry'].delete_one(
+                {'_id': 'reconciler'})
+            job = jobModel.createLocalJob(
+                module='girder.plugins.slicer_cli_web_ssr.image_job',
+                function='jobRefresh',
+                kwargs={'refreshList': [img_name], 'pull': False},
+                title='Refreshing changed docker images',
+                type='slicer_cli_web_ssr_job', user=self.admin, public=True)
+            self.assertEqual(rec.reconcile(), ([], []))
+            jobModel.remove(job)
+            self.assertEqual(rec.reconcile(), ([], [img_name]))
+            self.assertEqual(rec.reconcile(), ([], []))
+            self.assertEqual(refreshed, [img_name])
+            # a name the index cannot resolve but docker can is kept
+            localImages.clear()
+            otherImages[img_name] = imageModel.getImageIds(
+                [img_name])[img_name]
+            self.assertEqual(rec.reconcile(), ([], []))
+            self.imageIsLoaded(img_name, True)
+            otherImages.clear()
+            self.assertEqual(rec.reconcile(), ([img_name], []))
+        finally:
+            reconciler.LocalImageIndex = realImageIndex
+            reconciler.getDockerClient = realGetDockerClient
+            del imageModel.refreshImages
+        self.assertNoImages()
+
+    def testLazyEndpoints(self):
+        # the dispatcher routes serve the clis of the images registered when
+        # they are called, including images added after they were created
+        from girder.plugins.slicer_cli_web_ssr.constants import PluginSettings
+        from girder.plugins.slicer_cli_web_ssr.docker_resource import \
+            DockerResource
+
+        img_name = 'girder/slicer_cli_web:small'
+        self.assertNoImages()
+        self.model('setting').set(PluginSettings.LAZY_ENDPOINTS, True)
+        apiRoot = cherrypy.tree.apps['/api'].root.v1
+        resource = apiRoot.slicer_cli_web_ssr
+        lazyResource = DockerResource('slicer_cli_web_ssr')
+        self.assertTrue(lazyResource.lazyEndpoints)
+        apiRoot.slicer_cli_web_ssr = lazyResource
+        try:
+            self.addImage(img_name, JobStatus.SUCCESS)
+            self.endpointsExist(img_name, ['Example1', 'Example2'],
+                                ['Example3'])
+            prefix = '/slicer_cli_web_ssr/girder_slicer_cli_web_small/'
+            resp = self.request(path=prefix + 'Example1/xmlspec',
+                                user=self.admin, isJson=False)
+            self.assertStatusOk(resp)
+            self.assertIn('<executable>', self.getBody(resp))
+            resp = self.request(path=prefix + 'Example1/run',
+                                user=self.admin, method='POST')
+            self.assertNotEqual(resp.output_status[:3], b'404')
+            self.assertIn(('girder_slicer_cli_web_small', 'Example1', 'run'),
+                          lazyResource._lazyHandlers)
+            for path in (prefix + 'Example3/xmlspec',
+                         '/slicer_cli_web_ssr/null_null_null/Example1/xmlspec'):
+                resp = self.request(path=path, user=self.admin)
+                self.assertStatus(resp, 404)
+            resp = self.request(path=prefix + 'Example3/run',
+                                user=self.admin, method='POST')
+            self.assertStatus(resp, 404)
+        finally:
+            apiRoot.slicer_cli_web_ssr = resource
+            self.model('setting').unset(PluginSettings.LAZY_ENDPOINTS)
+        self.deleteImage(img_name, True)
+
     def testAddBadImage(self):
         # job should fail gracefully after pulling the image
         img_name = 'library/hello-world:latest'
@@ -247,6 +583,9 @@ class DockerImageManagementTest(base.TestCase):
             self.assertHasKeys(data[userAndRepo], [tag])
             self.assertNotHasKeys(data[userAndRepo][tag], [cli])
 
+    def getResource(self):
+        return cherrypy.tree.apps['/api'].root.v1.slicer_cli_web_ssr
+
     def getEndpoint(self):
         resp = self.request(path='/slicer_cli_web_ssr/slicer_cli_web_ssr/docker_image',
                             user=self.admin)
@@ -358,3 +697,43 @@ class DockerImageManagementTest(base.TestCase):
             del self.addHandler
             self.assertEqual(job_status[0], status,
                              'The status of the job should match ')
+
+    def refreshImages(self, name, status):
+        """
+        Test the refresh endpoint.
+
+        :param name: a string or a list of strings
+        :param status: either JobStatus.SUCCESS or JobStatus.ERROR.
+        :returns: the finished job.
+        """
+        event = threading.Event()
+        job_status = [None]
+
+        def tempListener(self, girderEvent):
+            job = girderEvent.info['job']
+
+            if (job['type'] == 'slicer_cli_web_ssr_job' and
+                    job['status'] in (JobStatus.SUCCESS, JobStatus.ERROR)):
+                job_status[0] = job['status']
+                events.unbind('jobs.job.update.after',
+                              'slicer_cli_web_ssr_refresh')
+                event.set()
+
+        self.refreshHandler = types.MethodType(tempListener, self)
+        events.bind('jobs.job.update.after', 'slicer_cli_web_ssr_refresh',
+                    self.refreshHandler)
+
+        resp = self.request(
+            path='/slicer_cli_web_ssr/slicer_cli_web_ssr/docker_image/refresh',
+            user=self.admin, method='POST', params={'name': json.dumps(name)})
+        self.assertStatusOk(resp)
+        jobId = resp.json['_id']
+
+        if not event.wait(TIMEOUT):
+            del self.refreshHandler
+            self.fail('refreshing the docker image is taking '
+                      'longer than %d seconds' % TIMEOUT)
+        del self.refreshHandler
+        self.assertEqual(job_status[0], status,
+                         'The status of the job should match ')
+        return self.model('job', 'jobs').load(jobId, force=True)
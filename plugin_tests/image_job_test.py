@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import json
+import time
+
+import docker
+import requests
+
+from tests import base
+
+
+# boiler plate to start and stop the server
+def setUpModule():
+    base.enabledPlugins.append('slicer_cli_web_ssr')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+LIMITS = {'timeout': 5, 'mem_limit': '1g', 'nano_cpus': 1000000000}
+
+
+class StubContainer(object):
+    """
+    A docker container whose run ends with the given exception or exit code
+    and output.
+    """
+
+    def __init__(self, command, error=None, statusCode=0, output=b''):
+        self.id = 'container'
+        self.command = command
+        self.error = error
+        self.statusCode = statusCode
+        self.output = output
+        self.removed = []
+
+    def start(self):
+        pass
+
+    def wait(self, timeout=None):
+        if self.error is not None:
+            raise self.error
+        return {'StatusCode': self.statusCode}
+
+    def logs(self, **kwargs):
+        return self.output
+
+    def remove(self, force=False):
+        self.removed.append(force)
+
+
+class StubClient(object):
+    """
+    A docker client that runs StubContainers, and lists the given metadata
+    containers.
+    """
+
+    def __init__(self, runs=None, listed=None):
+        # {command: keyword arguments of the StubContainer that runs it}
+        self.runs = runs or {}
+        self.listed = listed or []
+        self.created = []
+        self.removedIds = []
+        self.api = self
+        self.containers = self
+
+    def create(self, image, command, **kwargs):
+        cont = StubContainer(command, **self.runs.get(command, {}))
+        self.created.append(cont)
+        return cont
+
+    # docker.APIClient.containers
+    def __call__(self, all=False, filters=None):
+        return self.listed
+
+    def remove_container(self, id, force=False):
+        self.removedIds.append((id, force))
+
+
+class StubImage(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class StubDockerClient(StubClient, docker.DockerClient):
+    """
+    A StubClient that passes for a docker.DockerClient and has a single
+    image.
+    """
+    # shadow the properties of docker.DockerClient
+    api = containers = images = None
+
+    def __init__(self, imageId, runs):
+        StubClient.__init__(self, runs)
+        self.imageId = imageId
+        self.images = self
+
+    def get(self, name):
+        return StubImage(self.imageId)
+
+
+class StubJobModel(object):
+    def __init__(self):
+        self.logs = []
+
+    def updateJob(self, job, log=None, **kwargs):
+        if log:
+            self.logs.append(log)
+        return job
+
+
+class ImageJobTest(base.TestCase):
+
+    def setUp(self):
+        base.TestCase.setUp(self)
+        from girder.plugins.slicer_cli_web_ssr import image_job
+        from girder.plugins.slicer_cli_web_ssr.models import DockerImageError
+
+        self.image_job = image_job
+        self.DockerImageError = DockerImageError
+
+    def testGetDockerOutputTimeout(self):
+        # a container that does not finish is reported and force removed
+        client = StubClient({'--list_cli': {
+            'error': requests.exceptions.ReadTimeout()}})
+        with self.assertRaises(self.DockerImageError) as cm:
+            self.image_job.getDockerOutput(
+                'test/image', '--list_cli', client, LIMITS)
+        self.assertIn('did not finish within 5 seconds', str(cm.exception))
+        self.assertEqual(client.created[0].removed, [True])
+        # a container that fails is removed as well
+        client = StubClient({'--list_cli': {'statusCode': 1}})
+        with self.assertRaises(self.DockerImageError):
+            self.image_job.getDockerOutput(
+                'test/image', '--list_cli', client, LIMITS)
+        self.assertEqual(client.created[0].removed, [True])
+        client = StubClient({'--list_cli': {'output': b'{}'}})
+        self.assertEqual(self.image_job.getDockerOutput(
+            'test/image', '--list_cli', client, LIMITS), b'{}')
+        self.assertEqual(client.created[0].removed, [True])
+
+    def testReapMetadataContainers(self):
+        # only metadata containers that are older than maxAge are removed
+        now = time.time()
+        client = StubClient(listed=[
+            {'Id': 'old', 'Created': int(now - 3600)},
+            {'Id': 'recent', 'Created': int(now - 10)},
+            {'Id': 'older', 'Created': int(now - 7200)}])
+        self.assertEqual(
+            self.image_job.reapMetadataContainers(client, maxAge=600), 2)
+        self.assertEqual(client.removedIds,
+                         [('old', True), ('older', True)])
+
+    def testContainerExtraction(self):
+        # with container extraction, the image is asked for all xml specs in
+        # one run, and images that do not support it one cli at a time
+        from girder.plugins.slicer_cli_web_ssr.constants import PluginSettings
+        from girder.plugins.slicer_cli_web_ssr.models import DockerImage
+
+        bulk = '--list_cli %s' % self.image_job.BULK_XML_FLAG
+        self.model('setting').set(PluginSettings.METADATA_EXTRACTION,
+                                  'container')
+        try:
+            client = StubDockerClient('sha256:bulk', {bulk: {
+                'output': json.dumps({
+                    'cli1': {'type': 'python', 'xml': '<executable1/>'},
+                    'cli2': {'type': 'python', 'xml': '<executable2/>'},
+                }).encode('utf8')}})
+            img = DockerImage('test/bulk:latest')
+            cli_dict = self.image_job.getCliData(
+                img.name, client, img, StubJobModel(), {})
+            self.assertEqual([cont.command for cont in client.created],
+                             [bulk])
+            self.assertEqual(cli_dict['cli2'],
+                             {'type': 'python', 'xml': '<executable2/>'})
+            self.assertEqual(sorted(img.data[DockerImage.cli_dict]),
+                             ['cli1', 'cli2'])
+
+            client = StubDockerClient('sha256:fallback', {
+                bulk: {'statusCode': 1},
+                '--list_cli': {'output': json.dumps({
+                    'cli1': {'type': 'python'},
+                    'cli2': {'type': 'python'}}).encode('utf8')},
+                'cli1 --xml': {'output': b'<executable1/>'},
+                'cli2 --xml': {'output': b'<executable2/>'}})
+            img = DockerImage('test/fallback:latest')
+            jobModel = StubJobModel()
+            cli_dict = self.image_job.getCliData(
+                img.name, client, img, jobModel, {})
+            self.assertEqual(
+                sorted(cont.command for cont in client.created),
+                sorted([bulk, '--list_cli', 'cli1 --xml', 'cli2 --xml']))
+            self.assertEqual(cli_dict['cli1'],
+                             {'type': 'python', 'xml': b'<executable1/>'})
+            self.assertEqual(len(jobModel.logs), 2)
+            # every container was removed
+            self.assertTrue(all(cont.removed == [True]
+                                for cont in client.created))
+        finally:
+            self.model('setting').unset(PluginSettings.METADATA_EXTRACTION)
+
+    def testPullProgress(self):
+        # the layers of all pulled images add up to one progress total
+        class RecordingJobModel(object):
+            def __init__(self):
+                self.updates = []
+
+            def updateJob(self, job, **kwargs):
+                self.updates.append((kwargs['progressCurrent'],
+                                     kwargs['progressTotal']))
+
+        jobModel = RecordingJobModel()
+        progress = self.image_job.PullProgress(jobModel, {})
+        for (name, event) in (
+                ('a', {'status': 'Pulling from library/a', 'id': 'latest'}),
+                ('a', {'status': 'Already exists', 'id': 'layer1'}),
+                ('a', {'status': 'Downloading', 'id': 'layer2',
+                       'progressDetail': {'current': 50, 'total': 100}}),
+                ('b', {'status': 'Downloading', 'id': 'layer3',
+                       'progressDetail': {'current': 10, 'total': 200}}),
+                ('a', {'status': 'Download complete', 'id': 'layer2'}),
+                ('a', {'status': 'Extracting', 'id': 'layer2',
+                       'progressDetail': {'current': 20, 'total': 100}}),
+                ('b', {'status': 'Pull complete', 'id': 'layer3'}),
+                ('b', {'status': 'Status: Downloaded newer image for b'})):
+            progress.update(name, event)
+        self.assertEqual(jobModel.updates, [
+            (0, 0), (50, 100), (60, 300), (110, 300), (300, 300)])
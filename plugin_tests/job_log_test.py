@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+from tests import base
+
+
+# boiler plate to start and stop the server
+def setUpModule():
+    base.enabledPlugins.append('slicer_cli_web_ssr')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class CountingJobModel(object):
+    """
+    A job model that records the arguments of each updateJob call.
+    """
+
+    def __init__(self):
+        self.updates = []
+
+    def updateJob(self, job, **kwargs):
+        self.updates.append(kwargs)
+        return job
+
+
+class JobLogBufferTest(base.TestCase):
+
+    def setUp(self):
+        base.TestCase.setUp(self)
+        from girder.plugins.slicer_cli_web_ssr.job_log import JobLogBuffer
+
+        self.JobLogBuffer = JobLogBuffer
+        self.jobModel = CountingJobModel()
+
+    def testFlushBySize(self):
+        # log lines are written once maxLines of them are pending
+        buf = self.JobLogBuffer(self.jobModel, {}, interval=3600, maxLines=3)
+        buf.updateJob(log='1\n')
+        buf.updateJob(log='2\n')
+        self.assertEqual(self.jobModel.updates, [])
+        buf.updateJob(log='3\n')
+        self.assertEqual(self.jobModel.updates, [{'log': '1\n2\n3\n'}])
+
+    def testFlushByInterval(self):
+        # pending updates are written once interval seconds have passed
+        buf = self.JobLogBuffer(self.jobModel, {}, interval=3600, maxLines=50)
+        buf.updateJob(log='1\n', status=1)
+        self.assertEqual(self.jobModel.updates, [])
+        buf._lastFlush -= 3600
+        buf.updateJob(log='2\n')
+        self.assertEqual(self.jobModel.updates,
+                         [{'log': '1\n2\n', 'status': 1}])
+        # nothing is pending, so a flush does not write
+        buf.flush()
+        self.assertEqual(len(self.jobModel.updates), 1)
+
+    def testLatestFieldWins(self):
+        # only the latest pending value of each field is written
+        buf = self.JobLogBuffer(self.jobModel, {}, interval=3600, maxLines=50)
+        buf.updateJob(status=1, progressCurrent=10, progressTotal=100)
+        buf.updateJob(progressCurrent=50, progressMessage=None)
+        buf.flush(log='done\n', status=3)
+        self.assertEqual(self.jobModel.updates, [{
+            'log': 'done\n', 'status': 3, 'progressCurrent': 50,
+            'progressTotal': 100}])
+
+    def testFewerWrites(self):
+        # a burst of updates is written with a small fraction of the calls
+        buf = self.JobLogBuffer(self.jobModel, {}, interval=3600, maxLines=50)
+        for idx in range(1000):
+            buf.updateJob(log='cli %d\n' % idx, progressCurrent=idx)
+        buf.flush()
+        self.assertEqual(len(self.jobModel.updates), 20)
+        self.assertEqual(
+            ''.join(update['log'] for update in self.jobModel.updates),
+            ''.join('cli %d\n' % idx for idx in range(1000)))
+        self.assertEqual(self.jobModel.updates[-1]['progressCurrent'], 999)
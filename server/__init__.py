@@ -18,13 +18,139 @@
 ###############################################################################
 
 import json
+import os
+import re
 
-from girder import events
-from girder.models.model_base import ModelImporter
+from girder import events, logger
+from girder.models.model_base import ModelImporter, ValidationException
 from girder.constants import AccessType
+from girder.utility import setting_utilities
 
-from .rest_slicer_cli import genRESTEndPointsForSlicerCLIsInDockerCache
+from .constants import PluginSettings, METADATA_EXTRACTION_MODES
 from .docker_resource import DockerResource
+from .rest_slicer_cli import parseCLIsInDockerCache
+from .image_job import reapMetadataContainers
+from .reconciler import DockerImageReconciler
+from .endpoint_sync import EndpointSynchronizer
+
+
+@setting_utilities.validator({
+    PluginSettings.INGEST_CONCURRENCY,
+    PluginSettings.METADATA_CONTAINER_TIMEOUT,
+    PluginSettings.DOCKER_POOL_SIZE,
+    PluginSettings.RECONCILE_INTERVAL,
+    PluginSettings.ENDPOINT_SYNC_INTERVAL,
+})
+def validatePositiveInteger(doc):
+    val = doc['value']
+    try:
+        val = int(val)
+        if val < 1:
+            raise ValueError
+    except (ValueError, TypeError):
+        raise ValidationException('%s must be a positive integer.' % doc['key'],
+                                  'value')
+    doc['value'] = val
+
+
+@setting_utilities.validator(PluginSettings.METADATA_EXTRACTION)
+def validateMetadataExtraction(doc):
+    if doc['value'] not in METADATA_EXTRACTION_MODES:
+        raise ValidationException('%s must be one of %s.' % (
+            doc['key'], ', '.join(METADATA_EXTRACTION_MODES)), 'value')
+
+
+@setting_utilities.validator(PluginSettings.METADATA_CONTAINER_MEMORY)
+def validateMemoryLimit(doc):
+    val = str(doc['value']).strip().lower()
+    if not re.match(r'^[0-9]+[bkmg]?$', val):
+        raise ValidationException(
+            '%s must be a number of bytes with an optional unit (b, k, m, '
+            'or g).' % doc['key'], 'value')
+    doc['value'] = val
+
+
+@setting_utilities.validator(PluginSettings.METADATA_CONTAINER_CPUS)
+def validatePositiveNumber(doc):
+    val = doc['value']
+    try:
+        val = float(val)
+        if val <= 0:
+            raise ValueError
+    except (ValueError, TypeError):
+        raise ValidationException('%s must be a positive number.' % doc['key'],
+                                  'value')
+    doc['value'] = val
+
+
+@setting_utilities.validator(PluginSettings.CLI_PARSE_CACHE_DIR)
+def validateCLIParseCacheDir(doc):
+    val = (doc['value'] or '').strip()
+    if val and not os.path.isabs(val):
+        raise ValidationException('%s must be empty or an absolute path.' %
+                                  doc['key'], 'value')
+    doc['value'] = val
+
+
+@setting_utilities.validator(PluginSettings.LAZY_ENDPOINTS)
+def validateBoolean(doc):
+    val = doc['value']
+    if isinstance(val, bool):
+        return
+    if str(val).lower() not in ('true', 'false'):
+        raise ValidationException('%s must be a boolean.' % doc['key'],
+                                  'value')
+    doc['value'] = str(val).lower() == 'true'
+
+
+@setting_utilities.default(PluginSettings.INGEST_CONCURRENCY)
+def _defaultIngestConcurrency():
+    return 4
+
+
+@setting_utilities.default(PluginSettings.METADATA_EXTRACTION)
+def _defaultMetadataExtraction():
+    return 'static'
+
+
+@setting_utilities.default(PluginSettings.DOCKER_POOL_SIZE)
+def _defaultDockerPoolSize():
+    return 16
+
+
+@setting_utilities.default(PluginSettings.RECONCILE_INTERVAL)
+def _defaultReconcileInterval():
+    return 300
+
+
+@setting_utilities.default(PluginSettings.ENDPOINT_SYNC_INTERVAL)
+def _defaultEndpointSyncInterval():
+    return 5
+
+
+@setting_utilities.default(PluginSettings.CLI_PARSE_CACHE_DIR)
+def _defaultCLIParseCacheDir():
+    return ''
+
+
+@setting_utilities.default(PluginSettings.LAZY_ENDPOINTS)
+def _defaultLazyEndpoints():
+    return False
+
+
+@setting_utilities.default(PluginSettings.METADATA_CONTAINER_TIMEOUT)
+def _defaultMetadataContainerTimeout():
+    return 120
+
+
+@setting_utilities.default(PluginSettings.METADATA_CONTAINER_MEMORY)
+def _defaultMetadataContainerMemory():
+    return '1g'
+
+
+@setting_utilities.default(PluginSettings.METADATA_CONTAINER_CPUS)
+def _defaultMetadataContainerCpus():
+    return 1.0
 
 
 def _onUpload(event):
@@ -54,13 +180,25 @@ def load(info):
 
     dockerImageModel = ModelImporter.model('docker_image_model',
                                            'slicer_cli_web_ssr')
-    dockerCache = dockerImageModel.loadAllImages()
+    reapMetadataContainers(dockerImageModel.client)
 
-    genRESTEndPointsForSlicerCLIsInDockerCache(resource, dockerCache)
+    if not resource.lazyEndpoints:
+        # parse all cli specs, read with one query, first; the routes are
+        # then registered from the parse cache
+        try:
+            parseCLIsInDockerCache(dockerImageModel.getDockerCache())
+        except Exception:
+            logger.exception('Could not parse the cli xml specs')
+    resource.syncEndpoints()
 
     ModelImporter.model('job', 'jobs').exposeFields(level=AccessType.READ, fields={
         'slicerCLIBindings'})
 
     events.bind('jobs.job.update.after', resource.resourceName,
                 resource.AddRestEndpoints)
+
+    resource.reconciler = DockerImageReconciler(resource)
+    resource.reconciler.start()
+    resource.endpointSync = EndpointSynchronizer(resource)
+    resource.endpointSync.start()
     events.bind('data.process', info['name'], _onUpload)
@@ -25,10 +25,74 @@ class _MultilineHelpFormatter(argparse.HelpFormatter):
         return multiline_text
 
 
+_WITH_XML_FLAG = '--with-xml'
+
+
+def _get_cli_command(cli, cli_type):
+    """
+    Get the command used to run a cli from the working directory.
+
+    :param cli: the relative path of the cli.
+    :param cli_type: the type of the cli as listed in the cli list spec.
+    :returns: a list with the command and any leading arguments.
+    """
+    if cli_type == 'python':
+
+        script_file = os.path.join(cli, os.path.basename(cli) + '.py')
+
+        # python <cli-rel-path>/<cli-name>.py [<args>]
+        return [sys.executable, script_file]
+
+    elif cli_type == 'cxx':
+
+        script_file = os.path.join('.', cli, os.path.basename(cli))
+
+        if os.path.isfile(script_file):
+
+            # ./<cli-rel-path>/<cli-name> [<args>]
+            return [script_file]
+
+        # assumes parent dir of CLI executable is in ${PATH}
+        return [os.path.basename(cli)]
+
+    logger.exception('CLIs of type %s are not supported', cli_type)
+    raise Exception('CLIs of type %s are not supported' % cli_type)
+
+
+def _get_cli_list_spec_with_xml(cli_list_spec):
+    """
+    Add the xml spec of each cli to a copy of the cli list spec.  The xml is
+    read from <cli-rel-path>/<cli-name>.xml if that file exists, otherwise it
+    is the output of running the cli with --xml.  Clis whose xml cannot be
+    obtained are listed without an xml entry.
+
+    :param cli_list_spec: the parsed cli list spec.
+    :returns: a dictionary of {<cli>: {'type': <type>, 'xml': <xml>}}.
+    """
+    spec = {}
+    for cli, cli_spec in cli_list_spec.items():
+        spec[cli] = dict(cli_spec)
+        cli_path = os.path.normpath(cli)
+        xml_file = os.path.join(cli_path, os.path.basename(cli_path) + '.xml')
+        try:
+            if os.path.isfile(xml_file):
+                with open(xml_file) as f:
+                    xml = f.read()
+            else:
+                xml = subprocess.check_output(
+                    _get_cli_command(cli_path, cli_spec['type']) + ['--xml'])
+            if isinstance(xml, bytes):
+                xml = xml.decode('utf8')
+            spec[cli]['xml'] = xml
+        except Exception:
+            logger.exception('Could not get the xml spec of cli %s', cli)
+    return spec
+
+
 def _make_print_cli_list_spec_action(cli_list_spec_file):
 
-    # with open(cli_list_spec_file) as f:
-    #     str_cli_list_spec = f.read()
+    with open(cli_list_spec_file) as f:
+        str_cli_list_spec = f.read()
 
     class _PrintCLIListSpecAction(argparse.Action):
 
@@ -45,7 +109,14 @@ def _make_print_cli_list_spec_action(cli_list_spec_file):
                 help=help)
 
         def __call__(self, parser, namespace, values, option_string=None):
-            # print str_cli_list_spec
+            if _WITH_XML_FLAG in sys.argv[2:]:
+                # --list_cli --with-xml: emit the cli list and the xml spec
+                # of every cli as a single json document
+                sys.stdout.write(json.dumps(
+                    _get_cli_list_spec_with_xml(json.loads(str_cli_list_spec)),
+                    sort_keys=True) + '\n')
+            else:
+                sys.stdout.write(str_cli_list_spec + '\n')
             parser.exit()
 
     return _PrintCLIListSpecAction
@@ -69,7 +140,9 @@ def CLIListEntrypoint(cli_list_spec_file=None):
     cmdparser.add_argument(
         '--list_cli',
         action=_make_print_cli_list_spec_action(cli_list_spec_file),
-        help='Prints the json file containing the list of CLIs present'
+        help='Prints the json file containing the list of CLIs present.  '
+             'If followed by %s, the xml spec of each CLI is included.'
+             % _WITH_XML_FLAG
     )
 
     # add cl-rel-path argument
@@ -82,35 +155,8 @@ def CLIListEntrypoint(cli_list_spec_file=None):
 
     args.cli = os.path.normpath(args.cli)
 
-    if cli_list_spec[args.cli]['type'] == 'python':
-
-        script_file = os.path.join(args.cli,
-                                   os.path.basename(args.cli) + '.py')
-
-        # python <cli-rel-path>/<cli-name>.py [<args>]
-        output_code = subprocess.call([sys.executable, script_file] + sys.argv[2:])
-
-    elif cli_list_spec[args.cli]['type'] == 'cxx':
-
-        script_file = os.path.join('.', args.cli, os.path.basename(args.cli))
-
-        if os.path.isfile(script_file):
-
-            # ./<cli-rel-path>/<cli-name> [<args>]
-            output_code = subprocess.call([script_file] + sys.argv[2:])
-
-        else:
-
-            # assumes parent dir of CLI executable is in ${PATH}
-            output_code = subprocess.call([os.path.basename(args.cli)] + sys.argv[2:])
-
-    else:
-        logger.exception('CLIs of type %s are not supported',
-                         cli_list_spec[args.cli]['type'])
-        raise Exception(
-            'CLIs of type %s are not supported',
-            cli_list_spec[args.cli]['type']
-        )
+    command = _get_cli_command(args.cli, cli_list_spec[args.cli]['type'])
+    output_code = subprocess.call(command + sys.argv[2:])
 
     return output_code
 
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import os
+import pkg_resources
+import six
+import stat
+import sys
+import tempfile
+import threading
+
+from six.moves import cPickle as pickle
+
+from girder import logger
+from girder.models.model_base import ModelImporter
+
+from .constants import PluginSettings
+
+_cache = None
+_cacheLock = threading.Lock()
+
+# bump when the parse result changes shape, so old cache files are not read
+_FORMAT_VERSION = 1
+
+
+def _resultVersion():
+    """
+    Get a string that identifies the parser and pickle format of the parse
+    results, so that results from a different version are never loaded.
+    """
+    try:
+        parser = pkg_resources.get_distribution('ctk_cli').version
+    except pkg_resources.DistributionNotFound:
+        parser = 'unknown'
+    return 'ctk_cli%s-py%d-%d' % (parser, sys.version_info[0], _FORMAT_VERSION)
+
+
+def _secureDirectory(directory):
+    """
+    Create a directory that only girder can access, or check that an existing
+    one is owned by girder and cannot be written by anyone else.
+
+    :param directory: the directory path.
+    :returns: True if parse results may be persisted to the directory.
+    """
+    try:
+        if not os.path.exists(directory):
+            os.makedirs(directory, 0o700)
+        info = os.lstat(directory)
+    except OSError:
+        logger.exception('Could not create the cli parse cache directory %s',
+                         directory)
+        return False
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or
+            info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        logger.warning(
+            'Not caching cli parse results in %s: it must be a directory '
+            'owned by the girder user that no one else can write to',
+            directory)
+        return False
+    return True
+
+
+class CLIParseCache(object):
+    """
+    Memoizes parsed cli xml specs by content hash, in memory and optionally
+    pickled to a directory that only girder may write to.
+    """
+
+    def __init__(self, directory=None):
+        """
+        :param directory: a directory to persist parse results to, or None to
+            only keep them in memory.  It is created if it does not exist, and
+            ignored if someone other than girder could write to it.
+        """
+        if directory and not _secureDirectory(directory):
+            directory = None
+        self.directory = directory or None
+        self._suffix = '-%s.pickle' % _resultVersion()
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def get(self, xmlHash, loadXML, parse):
+        """
+        :param xmlHash: the content hash of the xml spec.
+        :param loadXML: a function without arguments that returns the xml
+            spec.  It is only called if the spec has to be parsed.
+        :param parse: a function that takes the xml spec and returns the
+            parse result.  Results are shared and must not be modified.
+        :returns: the parse result.
+        """
+        with self._lock:
+            if xmlHash in self._results:
+                return self._results[xmlHash]
+        result = self._read(xmlHash)
+        if result is None:
+            result = parse(loadXML())
+            self._write(xmlHash, result)
+        with self._lock:
+            # keep the first result if another thread parsed the same spec
+            return self._results.setdefault(xmlHash, result)
+
+    def put(self, xmlHash, result):
+        """
+        Add a parse result to the cache.
+
+        :param xmlHash: the content hash of the xml spec.
+        :param result: the parse result.
+        """
+        self._write(xmlHash, result)
+        with self._lock:
+            self._results.setdefault(xmlHash, result)
+
+    def parseMany(self, specs, parse):
+        """
+        Parse the xml specs that are not cached yet and cache the results.
+
+        :param specs: a dictionary of {content hash: xml spec}.
+        :param parse: a function that takes an xml spec and returns the parse
+            result.
+        :returns: the number of specs that were parsed.
+        """
+        pending = []
+        for (xmlHash, xml) in six.iteritems(specs):
+            if xmlHash in self:
+                continue
+            result = self._read(xmlHash)
+            if result is not None:
+                with self._lock:
+                    self._results.setdefault(xmlHash, result)
+            else:
+                pending.append((xmlHash, xml))
+        for (xmlHash, xml) in pending:
+            try:
+                result = parse(xml)
+            except Exception as err:
+                # generating the endpoint parses it again and reports it
+                logger.error('Could not parse cli xml spec %s: %s', xmlHash,
+                             err)
+                continue
+            self.put(xmlHash, result)
+        return len(pending)
+
+    def __contains__(self, xmlHash):
+        with self._lock:
+            return xmlHash in self._results
+
+    def _path(self, xmlHash):
+        return os.path.join(self.directory, xmlHash + self._suffix)
+
+    def _read(self, xmlHash):
+        if self.directory is None or not os.path.exists(self._path(xmlHash)):
+            return None
+        try:
+            with open(self._path(xmlHash), 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            logger.exception('Could not read the cached cli parse result %s',
+                             xmlHash)
+            return None
+
+    def _write(self, xmlHash, result):
+        if self.directory is None:
+            return
+        try:
+            # write to a temporary file and rename it, so that concurrent
+            # readers never see a partial file
+            fd, tempPath = tempfile.mkstemp(dir=self.directory,
+                                            suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tempPath, self._path(xmlHash))
+        except Exception:
+            logger.exception('Could not write the cli parse result %s',
+                             xmlHash)
+
+
+def getCLIParseCache():
+    """
+    Get the cli parse cache shared by this process.
+
+    :returns: a CLIParseCache.
+    """
+    global _cache
+
+    if _cache is not None:
+        return _cache
+    with _cacheLock:
+        if _cache is None:
+            directory = ModelImporter.model('setting').get(
+                PluginSettings.CLI_PARSE_CACHE_DIR)
+            if not isinstance(directory, six.string_types):
+                directory = None
+            _cache = CLIParseCache(directory)
+    return _cache
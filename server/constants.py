@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+
+class PluginSettings(object):
+    # maximum number of images pulled and queried at the same time by a
+    # single ingestion job
+    INGEST_CONCURRENCY = 'slicer_cli_web_ssr.ingest_concurrency'
+    # how cli metadata is extracted from an image: 'static' reads the cli list
+    # and xml files from the image filesystem without running it and only
+    # runs containers for clis without a static xml file; 'container' always
+    # runs the image's entrypoint
+    METADATA_EXTRACTION = 'slicer_cli_web_ssr.metadata_extraction'
+    # seconds a metadata container may run before it is killed
+    METADATA_CONTAINER_TIMEOUT = 'slicer_cli_web_ssr.metadata_container_timeout'
+    # memory limit of metadata containers, in docker format (e.g., 512m)
+    METADATA_CONTAINER_MEMORY = 'slicer_cli_web_ssr.metadata_container_memory'
+    # number of cpus metadata containers may use
+    METADATA_CONTAINER_CPUS = 'slicer_cli_web_ssr.metadata_container_cpus'
+    # maximum number of connections kept open to the docker daemon
+    DOCKER_POOL_SIZE = 'slicer_cli_web_ssr.docker_pool_size'
+    # seconds between full reconciliations of the registered images with the
+    # local docker images
+    RECONCILE_INTERVAL = 'slicer_cli_web_ssr.reconcile_interval'
+    # seconds between checks of the shared image registry version, after
+    # which endpoints are updated for images changed by other girder
+    # processes
+    ENDPOINT_SYNC_INTERVAL = 'slicer_cli_web_ssr.endpoint_sync_interval'
+    # directory in which parsed cli xml specs are kept across restarts; empty
+    # to only keep them in memory
+    CLI_PARSE_CACHE_DIR = 'slicer_cli_web_ssr.cli_parse_cache_dir'
+    # if true, the cli endpoints are served by two generic routes that build
+    # each cli's handler the first time it is called, instead of registering
+    # routes for every cli up front; read when the plugin is loaded
+    LAZY_ENDPOINTS = 'slicer_cli_web_ssr.lazy_endpoints'
+
+
+METADATA_EXTRACTION_MODES = ('static', 'container')
+
+# file names, relative to the image's working directory, that may hold the cli
+# list spec
+CLI_LIST_SPEC_FILES = ('slicer_cli_list.json', 'cli_list.json')
+
+# label added to every container created to extract cli metadata, so that
+# containers left over by crashed jobs can be found and removed
+METADATA_CONTAINER_LABEL = 'slicer_cli_web_ssr.metadata'
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import threading
+
+import docker
+
+from girder import logger
+from girder.models.model_base import ModelImporter
+
+from .constants import PluginSettings
+
+_client = None
+_clientLock = threading.Lock()
+
+
+def getDockerClient():
+    """
+    Get the docker client shared by this process, creating it on first use
+    with a pool of slicer_cli_web_ssr.docker_pool_size connections.
+
+    :returns: a docker.DockerClient.
+    :raises docker.errors.DockerException: if the client cannot be created.
+    """
+    global _client
+
+    if _client is not None:
+        return _client
+    with _clientLock:
+        if _client is None:
+            poolSize = int(ModelImporter.model('setting').get(
+                PluginSettings.DOCKER_POOL_SIZE))
+            try:
+                client = docker.from_env(version='auto',
+                                         max_pool_size=poolSize)
+            except docker.errors.DockerException:
+                logger.exception('Could not create the docker client')
+                raise
+            logger.info('Created docker client using API version %s',
+                        client.api.api_version)
+            _client = client
+    return _client
+
+
+def _normalizeImageName(name):
+    """
+    Normalize a docker image reference the way docker resolves it, so that
+    the different spellings of an image compare equal (e.g.,
+    docker.io/library/ubuntu:latest, library/ubuntu and ubuntu).
+    """
+    for prefix in ('docker.io/', 'index.docker.io/', 'library/'):
+        if name.startswith(prefix):
+            name = name[len(prefix):]
+    # a name without a tag or digest refers to its latest tag; a ':' before
+    # the last '/' is a registry port
+    if '@' not in name and ':' not in name.rsplit('/', 1)[-1]:
+        name += ':latest'
+    return name
+
+
+class LocalImageIndex(object):
+    """
+    A snapshot of the images on the local docker engine, built from a single
+    image list call, that maps references and image ids to image ids.
+    """
+
+    def __init__(self, client):
+        """
+        :param client: a docker.DockerClient.
+        :raises docker.errors.APIError: if the images cannot be listed.
+        """
+        self.client = client
+        self.ids = set()
+        self.names = {}
+        # {name: image id or None} of the names looked up with images.get
+        self._fallback = {}
+        for image in client.api.images():
+            self.ids.add(image['Id'])
+            for ref in (image.get('RepoTags') or []) + (
+                    image.get('RepoDigests') or []):
+                self.names[_normalizeImageName(ref)] = image['Id']
+
+    def getImageId(self, name):
+        """
+        Get the id of a local image.  Names the snapshot does not resolve are
+        looked up once with the docker client before they are reported as
+        missing.
+
+        :param name: a docker image name, or a full or short image id.
+        :returns: the image id, or None if the image is not local.
+        :raises docker.errors.APIError: if a name cannot be looked up.
+        """
+        imageId = self.names.get(_normalizeImageName(name))
+        if imageId is None:
+            imageId = self._getImageIdByPrefix(name)
+        if imageId is None:
+            if name not in self._fallback:
+                try:
+                    self._fallback[name] = self.client.images.get(name).id
+                except docker.errors.ImageNotFound:
+                    self._fallback[name] = None
+            imageId = self._fallback[name]
+        return imageId
+
+    def _getImageIdByPrefix(self, name):
+        prefix = name[len('sha256:'):] if name.startswith('sha256:') else name
+        if not prefix or any(c not in '0123456789abcdef' for c in prefix):
+            return None
+        matches = [imageId for imageId in self.ids
+                   if imageId.split(':')[-1].startswith(prefix)]
+        # like docker, an ambiguous prefix does not match
+        return matches[0] if len(matches) == 1 else None
+
+    def exists(self, name):
+        return self.getImageId(name) is not None
@@ -18,8 +18,12 @@
 ###############################################################################
 
 
+import collections
+import contextlib
+import functools
 import six
 import json
+import threading
 
 from girder.api.v1.resource import Resource, RestException
 from girder import logger
@@ -28,9 +32,12 @@ from girder.utility.model_importer import ModelImporter
 
 from girder.api import access
 from girder.api.describe import Description, describeRoute
-from .rest_slicer_cli import genRESTEndPointsForSlicerCLIsInDockerCache
+from .constants import PluginSettings
+from .rest_slicer_cli import genRESTEndPointsForSlicerCLIsInDockerCache, \
+    genHandlerToRunDockerCLI, genHandlerToGetDockerCLIXmlSpec, \
+    getImageRestPath, resourceServesImage
 from girder.plugins.jobs.constants import JobStatus
-from models import DockerImageNotFoundError, DockerImage
+from models import DockerImageNotFoundError, DockerImage, DockerCache
 
 
 class DockerResource(Resource):
@@ -42,13 +49,108 @@ class DockerResource(Resource):
     jobType = 'slicer_cli_web_ssr_job'
 
     def __init__(self, name):
+        # while the endpoints are being changed, the thread changing them sees
+        # staged copies of the route table and of currentEndpoints; see
+        # _stagedEndpoints
+        self._staging = threading.local()
         super(DockerResource, self).__init__()
         self.currentEndpoints = {}
+        # the revision of the image metadata each image's endpoints were
+        # generated from
+        self.endpointRevisions = {}
+        # {image name: {cli: hash of the xml spec its endpoints were
+        # generated from}}
+        self.endpointXMLHashes = {}
+        # serializes changes to the endpoints made by job events, requests,
+        # the reconciler and the endpoint synchronizer
+        self._endpointLock = threading.RLock()
         self.resourceName = name
         self.jobType = 'slicer_cli_web_ssr_job'
         self.route('PUT', (name, 'docker_image'), self.setImages)
         self.route('DELETE', (name, 'docker_image'), self.deleteImage)
         self.route('GET', (name, 'docker_image'), self.getDockerImages)
+        self.route('POST', (name, 'docker_image', 'refresh'),
+                   self.refreshImages)
+        self.lazyEndpoints = bool(ModelImporter.model('setting').get(
+            PluginSettings.LAZY_ENDPOINTS))
+        if self.lazyEndpoints:
+            # ({image rest path: DockerImage}, the DockerCache it is built
+            # from), replaced as a whole when the cache changes
+            self._lazyImages = ({}, None)
+            # {(image rest path, cli, operation): (xml hash, handler)}
+            self._lazyHandlers = {}
+            # guards _lazyImages and _lazyHandlers
+            self._lazyLock = threading.Lock()
+            self.route('POST', (':image', ':cli', 'run'), self.runCLI)
+            self.route('GET', (':image', ':cli', 'xmlspec'),
+                       self.getCLIXMLSpec)
+
+    @property
+    def _routes(self):
+        if getattr(self._staging, 'active', False):
+            return self._staging.routes
+        return self._liveRoutes
+
+    @_routes.setter
+    def _routes(self, routes):
+        self._liveRoutes = routes
+
+    @property
+    def currentEndpoints(self):
+        if getattr(self._staging, 'active', False):
+            return self._staging.endpoints
+        return self._liveEndpoints
+
+    @currentEndpoints.setter
+    def currentEndpoints(self, endpoints):
+        self._liveEndpoints = endpoints
+
+    @contextlib.contextmanager
+    def _stagedEndpoints(self):
+        """
+        Change copies of the route table and of currentEndpoints in the
+        calling thread and publish both at once when the block exits without
+        an error; nested calls join the outer staging.
+        """
+        with self._endpointLock:
+            if getattr(self._staging, 'active', False):
+                yield
+                return
+            routes = collections.defaultdict(
+                lambda: collections.defaultdict(list))
+            # request threads may add empty entries to the live defaultdicts,
+            # so iterate over lists taken in one step
+            for (method, byLength) in list(self._liveRoutes.items()):
+                for (length, entries) in list(byLength.items()):
+                    routes[method][length] = list(entries)
+            self._staging.routes = routes
+            self._staging.endpoints = {
+                imageName: {cli: dict(ops) for (cli, ops) in six.iteritems(clis)}
+                for (imageName, clis) in six.iteritems(self._liveEndpoints)}
+            # [(attribute name, handler)] of the removed endpoints
+            self._staging.removedHandlers = []
+            revisions = dict(self.endpointRevisions)
+            xmlHashes = {imageName: dict(clis) for (imageName, clis) in
+                         six.iteritems(self.endpointXMLHashes)}
+            self._staging.active = True
+            try:
+                yield
+            except Exception:
+                # keep the live tables and the bookkeeping that matches them
+                self.endpointRevisions = revisions
+                self.endpointXMLHashes = xmlHashes
+                raise
+            else:
+                self._liveRoutes = self._staging.routes
+                self._liveEndpoints = self._staging.endpoints
+                for (name, handler) in self._staging.removedHandlers:
+                    # the handler may have been generated again meanwhile
+                    if getattr(self, name, None) is handler:
+                        delattr(self, name)
+            finally:
+                self._staging.active = False
+                self._staging.routes = self._staging.endpoints = None
+                self._staging.removedHandlers = None
 
     @access.user
     @describeRoute(
@@ -63,31 +165,49 @@ class DockerResource(Resource):
         dockerCache = dockermodel.loadAllImages()
         cache = dockerCache.getImages()
 
+        # the endpoint data may be replaced by another thread; use one
+        # snapshot of it
+        currentEndpoints = self.currentEndpoints
+        if self.lazyEndpoints:
+            lazyImages = self._getLazyImages(dockerCache)
+            currentEndpoints = {}
+            for val in cache:
+                currentEndpoints.update(
+                    self._lazyEndpointData(val, lazyImages))
+
         data = {}
         for val in cache:
-            name, tag, imgData = self.createRestDataForImageVersion(val)
+            name, tag, imgData = self.createRestDataForImageVersion(
+                val, currentEndpoints)
             if name != 'skip':
                 data.setdefault(name, {})[tag] = imgData
 
         return data
 
-    def createRestDataForImageVersion(self, dockerImage):
+    def createRestDataForImageVersion(self, dockerImage,
+                                      currentEndpoints=None):
         """
         Creates a dictionary with rest endpoint information for the given
         DockerImage object
 
         :param dockerImage: DockerImage object
+        :param currentEndpoints: a snapshot of the endpoint data, or None to
+            use the current one.
 
         :returns: structured dictionary documenting clis and rest
             endpoints for this image version
         """
 
         name = dockerImage.name
+        if currentEndpoints is None:
+            currentEndpoints = self.currentEndpoints
+            if self.lazyEndpoints:
+                currentEndpoints = self._lazyEndpointData(dockerImage)
 
         # print name
-        if name in self.currentEndpoints:
+        if name in currentEndpoints:
             # print name
-            endpointData = self.currentEndpoints[name]
+            endpointData = currentEndpoints[name]
 
             if ':' in name:
                 imageAndTag = name.split(':')
@@ -157,14 +277,17 @@ class DockerResource(Resource):
 
         dockermodel = ModelImporter.model('docker_image_model',
                                           'slicer_cli_web_ssr')
-        try:
-            dockermodel.removeImages(names)
-
-            self.deleteImageEndpoints(names)
-            if deleteImage:
-                dockermodel.delete_docker_image_from_repo(names, self.jobType)
-        except DockerImageNotFoundError as err:
-            raise RestException('Invalid docker image name. ' + str(err))
+        notFound = dockermodel.removeImages(names)
+        removed = [name for name in names if name not in notFound]
+
+        self.deleteImageEndpoints(removed)
+        if deleteImage and removed:
+            dockermodel.delete_docker_image_from_repo(removed, self.jobType)
+        if notFound:
+            raise RestException('Invalid docker image name. ' + str(
+                DockerImageNotFoundError(
+                    'The following images do not exist in the database',
+                    notFound)))
 
     def parseImageNameList(self, param):
         """
@@ -218,6 +341,123 @@ class DockerResource(Resource):
         # print docker_image_model.putDockerImage(nameList, self.jobType, True)
         return docker_image_model.putDockerImage(nameList, self.jobType, True)
 
+    def _lazyEndpointData(self, dockerImage, lazyImages=None):
+        """
+        Describe the endpoints the dispatcher routes serve for an image, in
+        the format of currentEndpoints.
+
+        :param lazyImages: the result of _getLazyImages, or None to get it.
+        """
+        if lazyImages is None:
+            lazyImages = self._getLazyImages()
+        restPath = getImageRestPath(dockerImage.name)
+        if restPath not in lazyImages:
+            return {}
+        return {dockerImage.name: {
+            cli: {
+                'run': ['POST', (restPath, cli, 'run'), 'runCLI'],
+                'xmlspec': ['GET', (restPath, cli, 'xmlspec'),
+                            'getCLIXMLSpec'],
+            } for cli in dockerImage.getCLIListSpec()}}
+
+    def _getLazyImages(self, cache=None):
+        """
+        :param cache: the current DockerCache, or None to get it.
+        :returns: a dictionary of {image rest path: DockerImage} of the images
+            this resource serves.
+        """
+        if cache is None:
+            cache = ModelImporter.model(
+                'docker_image_model', 'slicer_cli_web_ssr').getDockerCache()
+        with self._lazyLock:
+            images, builtFrom = self._lazyImages
+            if builtFrom is not cache:
+                images = {}
+                for img in cache.getImages():
+                    if resourceServesImage(self, img.name):
+                        images[getImageRestPath(img.name)] = img
+                self._lazyImages = (images, cache)
+                # forget the handlers of images that are gone
+                self._lazyHandlers = {
+                    key: val for (key, val) in six.iteritems(self._lazyHandlers)
+                    if key[0] in images}
+        return images
+
+    def _getLazyHandler(self, image, cli, operation):
+        """
+        Get the handler of a cli endpoint, generating it the first time it is
+        needed and again if the cli's xml spec changed.
+
+        :param image: the image rest path from the route.
+        :param cli: the cli name from the route.
+        :param operation: 'run' or 'xmlspec'.
+        :returns: the handler.
+        """
+        img = self._getLazyImages().get(image)
+        if img is None or cli not in img.getCLIListSpec():
+            raise RestException('No CLI %s in image %s.' % (cli, image),
+                                code=404)
+        xmlHash = img.getCLIXMLHash(cli)
+        key = (image, cli, operation)
+        with self._lazyLock:
+            cached = self._lazyHandlers.get(key)
+        if cached is not None and cached[0] == xmlHash:
+            return cached[1]
+        loadXML = functools.partial(img.getCLIXML, cli)
+        if operation == 'run':
+            handler = genHandlerToRunDockerCLI(img.name, cli, loadXML, self,
+                                               xmlHash)
+        else:
+            handler = genHandlerToGetDockerCLIXmlSpec(cli, loadXML, self)
+        with self._lazyLock:
+            self._lazyHandlers[key] = (xmlHash, handler)
+        return handler
+
+    @access.user
+    @describeRoute(
+        Description('Run a CLI of a docker image')
+        .notes('The parameters depend on the CLI; see its XML spec.')
+        .param('image', 'The docker image name, with \':\', \'/\' and \'@\' '
+               'replaced by \'_\'.', paramType='path')
+        .param('cli', 'The name of the CLI.', paramType='path')
+        .errorResponse('The image or CLI does not exist.')
+    )
+    def runCLI(self, image, cli, params):
+        return self._getLazyHandler(image, cli, 'run')(params=params)
+
+    @access.user
+    @describeRoute(
+        Description('Get the XML spec of a CLI of a docker image')
+        .param('image', 'The docker image name, with \':\', \'/\' and \'@\' '
+               'replaced by \'_\'.', paramType='path')
+        .param('cli', 'The name of the CLI.', paramType='path')
+        .errorResponse('The image or CLI does not exist.')
+    )
+    def getCLIXMLSpec(self, image, cli, params):
+        return self._getLazyHandler(image, cli, 'xmlspec')(params=params)
+
+    @access.admin
+    @describeRoute(
+        Description('Re-extract the CLIs of images whose tag moved')
+        .notes('Must be a system administrator to call this.  Only images '
+               'whose name now resolves to a different docker image than '
+               'when its CLIs were cached are re-extracted.')
+        .param('name', 'A name or a list of names of registered docker '
+               'images to check.  If not specified, all registered images '
+               'are checked.', required=False)
+        .param('pull', 'If True, each image is pulled before it is checked.',
+               required=False, dataType='boolean', default=False)
+        .errorResponse('You are not a system administrator.', 403)
+    )
+    def refreshImages(self, params):
+        nameList = None
+        if 'name' in params:
+            nameList = self.parseImageNameList(params['name'])
+        pull = str(params.get('pull', False)).lower() == 'true'
+        docker_image_model = ModelImporter.model('docker_image_model',
+                                                 'slicer_cli_web_ssr')
+        return docker_image_model.refreshImages(nameList, self.jobType, pull)
+
     def storeEndpoints(self, imgName, cli, operation, argList):
         """
         Information on each rest endpoint is saved so they can be
@@ -256,39 +496,98 @@ class DockerResource(Resource):
 
     def deleteImageEndpoints(self, imageList=None):
 
-        if imageList is None:
-            imageList = self.currentEndpoints.keys()
-        for imageName in imageList:
-            if imageName in self.currentEndpoints:
-                for (cli, val) in six.iteritems(
-                        self.currentEndpoints[imageName]):
-                    for (operation, endpoint) in six.iteritems(val):
-                        try:
-                            self.removeRoute(endpoint[0], endpoint[1],
-                                             getattr(self, endpoint[2]))
-                            delattr(self, endpoint[2])
-                        except Exception:
-                            logger.exception('Failed to remove route')
-            del self.currentEndpoints[imageName]
+        with self._stagedEndpoints():
+            if imageList is None:
+                imageList = list(self.currentEndpoints.keys())
+            for imageName in imageList:
+                self.endpointRevisions.pop(imageName, None)
+                self.endpointXMLHashes.pop(imageName, None)
+                if imageName in self.currentEndpoints:
+                    self.deleteCLIEndpoints(
+                        imageName, list(self.currentEndpoints[imageName]))
+                    del self.currentEndpoints[imageName]
+
+    def deleteCLIEndpoints(self, imageName, cliList):
+        """
+        Remove the endpoints of some of the clis of an image.
+
+        :param imageName: the docker image name.
+        :param cliList: a list of cli names.
+        """
+        with self._stagedEndpoints():
+            endpoints = self.currentEndpoints.get(imageName, {})
+            for cli in cliList:
+                if cli not in endpoints:
+                    continue
+                for (operation, endpoint) in six.iteritems(endpoints[cli]):
+                    try:
+                        handler = getattr(self, endpoint[2])
+                        self.removeRoute(endpoint[0], endpoint[1], handler)
+                        self._staging.removedHandlers.append(
+                            (endpoint[2], handler))
+                    except Exception:
+                        logger.exception('Failed to remove route')
+                del endpoints[cli]
+                self.endpointXMLHashes.get(imageName, {}).pop(cli, None)
+
+    def syncEndpoints(self):
+        """
+        Update only the endpoints of the clis that were added, removed, or
+        whose xml spec changed since the endpoints were generated.
+
+        :returns: a tuple of the list of image names whose endpoints were
+            all removed and a dictionary of {image name: list of clis} whose
+            endpoints were (re)generated.
+        """
+        if self.lazyEndpoints:
+            # the dispatcher routes look up the images on each request
+            return [], {}
+        dockermodel = ModelImporter.model('docker_image_model',
+                                          'slicer_cli_web_ssr')
+        with self._stagedEndpoints():
+            images = {img.name: img for img in
+                      dockermodel.getDockerCache().getImages()}
+            removed = [name for name in self.endpointRevisions
+                       if name not in images]
+            self.deleteImageEndpoints(removed)
+            cache = DockerCache()
+            generate = {}
+            hashes = {}
+            for (name, img) in six.iteritems(images):
+                if (name in self.endpointRevisions and
+                        self.endpointRevisions[name] == img.getRevision()):
+                    continue
+                hashes[name] = {cli: img.getCLIXMLHash(cli)
+                                for cli in img.getCLIListSpec()}
+                old = self.endpointXMLHashes.get(name, {})
+                self.deleteCLIEndpoints(name, [
+                    cli for cli in old if hashes[name].get(cli) != old[cli]])
+                generate[name] = [
+                    cli for cli in hashes[name]
+                    if cli not in self.currentEndpoints.get(name, {})]
+                if generate[name]:
+                    cache.addImage(img)
+            genRESTEndPointsForSlicerCLIsInDockerCache(self, cache, generate)
+            for name in hashes:
+                self.endpointRevisions[name] = images[name].getRevision()
+                self.endpointXMLHashes[name] = {
+                    cli: hashes[name][cli]
+                    for cli in self.currentEndpoints.get(name, {})}
+            generate = {name: clis for (name, clis) in six.iteritems(generate)
+                        if clis}
+            if removed or generate:
+                logger.info('Updated docker image endpoints: %d images '
+                            'removed, %d clis generated', len(removed),
+                            sum(len(clis) for clis in generate.values()))
+        return removed, generate
 
     def AddRestEndpoints(self, event):
         """
-        Determines if the job event being triggered is due to the caching of
-        new docker images or deleting a docker image off the local machine.  If
-        a new image is being loaded all old rest endpoints are deleted and
-        endpoints fro all cached docker images are regenerated.
+        Updates the endpoints when a docker image job succeeds.
 
         :param event: An event dictionary
         """
         job = event.info['job']
 
         if job['type'] == self.jobType and job['status'] == JobStatus.SUCCESS:
-
-            # remove all previous endpoints
-            dockermodel = ModelImporter.model('docker_image_model',
-                                              'slicer_cli_web_ssr')
-
-            cache = dockermodel.loadAllImages()
-
-            self.deleteImageEndpoints()
-            genRESTEndPointsForSlicerCLIsInDockerCache(self, cache)
+            self.syncEndpoints()
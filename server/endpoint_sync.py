@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import threading
+
+from girder import logger
+from girder.models.model_base import ModelImporter
+
+from .constants import PluginSettings
+
+
+class EndpointSynchronizer(object):
+    """
+    Updates the endpoints when the shared image registry version changes,
+    e.g., after another girder process saved images.
+    """
+
+    def __init__(self, resource, interval=None):
+        """
+        :param resource: the DockerResource whose endpoints are maintained.
+        :param interval: the number of seconds between checks of the registry
+            version.  If None, the slicer_cli_web_ssr.endpoint_sync_interval
+            setting is used.
+        """
+        self.resource = resource
+        self.interval = interval
+        self._stop = threading.Event()
+        self._version = None
+
+    def start(self):
+        if self.interval is None:
+            self.interval = float(ModelImporter.model('setting').get(
+                PluginSettings.ENDPOINT_SYNC_INTERVAL))
+        thread = threading.Thread(target=self._pollLoop)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _pollLoop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception('Failed to synchronize docker image endpoints')
+
+    def check(self):
+        """
+        Update the endpoints if the registry version changed since the last
+        check.
+
+        :returns: True if the endpoints were synchronized.
+        """
+        imageModel = ModelImporter.model('docker_image_model',
+                                         'slicer_cli_web_ssr')
+        version = imageModel.getRegistryVersion()
+        if version == self._version:
+            return False
+        self.resource.syncEndpoints()
+        # only remember the version once the endpoints were updated, so a
+        # failed update is retried on the next check
+        self._version = version
+        return True
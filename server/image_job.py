@@ -18,14 +18,30 @@
 ###############################################################################
 
 import docker
+import os
+import posixpath
+import requests
+import six
+import tarfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 from girder import logger
 from girder.models.model_base import ModelImporter
 from girder.plugins.jobs.constants import JobStatus
 import json
+from .constants import PluginSettings, CLI_LIST_SPEC_FILES, \
+    METADATA_CONTAINER_LABEL
+from .docker_client import getDockerClient
+from .job_log import JobLogBuffer
 from .models import DockerImage, DockerImageError, \
     DockerImageNotFoundError, DockerCache
 from six import iteritems
+
+# passed after --list_cli to ask an image for every cli's xml spec in the
+# same run
+BULK_XML_FLAG = '--with-xml'
 # import sys
 # import linecache
 
@@ -39,10 +55,9 @@ def deleteImage(job):
 
     """
 
-    jobModel = ModelImporter.model('job', 'jobs')
+    jobLog = JobLogBuffer(ModelImporter.model('job', 'jobs'), job)
 
-    jobModel.updateJob(
-        job,
+    jobLog.flush(
         log='Started to Delete Docker images\n',
         status=JobStatus.RUNNING,
     )
@@ -51,11 +66,11 @@ def deleteImage(job):
         error = False
 
         try:
-            docker_client = docker.from_env(version='auto')
+            docker_client = getDockerClient()
 
         except docker.errors.DockerException as err:
             logger.exception('Could not create the docker client')
-            jobModel.updateJob(
+            jobLog.updateJob(
                 job,
                 log='Failed to create the Docker Client\n' + str(err) + '\n',
                 status=JobStatus.ERROR,
@@ -68,15 +83,14 @@ def deleteImage(job):
 
             except Exception as err:
                 logger.exception('Failed to remove image')
-                jobModel.updateJob(
+                jobLog.updateJob(
                     job,
                     log='Failed to remove image \n' + str(err) + '\n',
                     status=JobStatus.RUNNING,
                 )
                 error = True
         if error is True:
-            jobModel.updateJob(
-                job,
+            jobLog.flush(
                 log='Failed to remove some images',
                 status=JobStatus.ERROR,
                 notify=True,
@@ -84,8 +98,7 @@ def deleteImage(job):
             )
         else:
 
-            jobModel.updateJob(
-                job,
+            jobLog.flush(
                 log='Removed all images',
                 status=JobStatus.SUCCESS,
                 notify=True,
@@ -93,11 +106,9 @@ def deleteImage(job):
             )
     except Exception as err:
         logger.exception('Error with job')
-        jobModel.updateJob(
-            job,
+        jobLog.flush(
             log='Error with job \n ' + str(err) + '\n',
             status=JobStatus.ERROR,
-
         )
 
 
@@ -121,46 +132,61 @@ def jobPullAndLoad(job):
      is ERROR or SUCCESS.
     Event listeners check the jobtype to determine if a job is Dockerimage
     related
+
+    When the ingestion concurrency (the job's ``concurrency`` kwarg, or the
+    ``slicer_cli_web_ssr.ingest_concurrency`` setting) is greater than one,
+    each image is pulled and queried independently by a bounded pool of
+    worker threads and the results are merged once all images are done.
     """
+    jobLog = JobLogBuffer(ModelImporter.model('job', 'jobs'), job)
     try:
-        jobModel = ModelImporter.model('job', 'jobs')
         pullList = job['kwargs']['pullList']
         loadList = job['kwargs']['loadList']
+        concurrency = job['kwargs'].get('concurrency') or \
+            ModelImporter.model('setting').get(
+                PluginSettings.INGEST_CONCURRENCY)
 
         errorState = False
 
         notExistSet = set()
 
-        jobModel.updateJob(
-            job,
+        jobLog.flush(
             log='Started to Load Docker images\n',
             status=JobStatus.RUNNING,
         )
 
         try:
-            docker_client = docker.from_env(version='auto')
+            docker_client = getDockerClient()
 
         except docker.errors.DockerException as err:
             logger.exception('Could not create the docker client')
-            jobModel.updateJob(
+            jobLog.updateJob(
                 job,
                 log='Failed to create the Docker Client\n' + str(err) + '\n',
             )
             raise DockerImageError('Could not create the docker client')
 
-        try:
-            pullDockerImage(docker_client, pullList)
-        except DockerImageNotFoundError as err:
-            errorState = True
-            notExistSet = set(err.imageName)
-            jobModel.updateJob(
-                job,
-                log='could not find the following '
-                    'images\n'+'\n'.join(notExistSet)+'\n',
-                status=JobStatus.ERROR,
-            )
-        cache, loadingError = LoadMetadata(jobModel, job, docker_client,
-                                           pullList, loadList, notExistSet)
+        reapMetadataContainers(docker_client)
+
+        if int(concurrency) > 1 and len(pullList) + len(loadList) > 1:
+            cache, loadingError = LoadMetadataConcurrently(
+                jobLog, job, docker_client, pullList, loadList,
+                int(concurrency))
+        else:
+            try:
+                pullDockerImage(docker_client, pullList,
+                                PullProgress(jobLog, job))
+            except DockerImageNotFoundError as err:
+                errorState = True
+                notExistSet = set(err.imageName)
+                jobLog.updateJob(
+                    job,
+                    log='could not find the following '
+                        'images\n'+'\n'.join(notExistSet)+'\n',
+                    status=JobStatus.ERROR,
+                )
+            cache, loadingError = LoadMetadata(jobLog, job, docker_client,
+                                               pullList, loadList, notExistSet)
         imageModel = ModelImporter.model('docker_image_model',
                                          'slicer_cli_web_ssr')
 
@@ -169,8 +195,7 @@ def jobPullAndLoad(job):
             newStatus = JobStatus.SUCCESS
         else:
             newStatus = JobStatus.ERROR
-        jobModel.updateJob(
-            job,
+        jobLog.flush(
             log='Finished caching Docker image data\n',
             status=newStatus,
             notify=True,
@@ -179,8 +204,117 @@ def jobPullAndLoad(job):
     except Exception as err:
 
         logger.exception('Error with job')
-        jobModel.updateJob(
+        jobLog.flush(
+            log='Error with job \n ' + str(err) + '\n',
+            status=JobStatus.ERROR,
+        )
+
+
+def jobRefresh(job):
+    """
+    Re-extracts cli metadata for registered images whose name now resolves to
+    a different docker image id than the one recorded at ingestion time.
+    Images are optionally pulled first so tags that moved in the registry are
+    noticed.  Unchanged images are left alone, so refreshing a large number
+    of tags only costs an inspect per tag plus extraction of the few that
+    moved.
+    """
+    jobLog = JobLogBuffer(ModelImporter.model('job', 'jobs'), job)
+    try:
+        refreshList = job['kwargs']['refreshList']
+        pull = job['kwargs'].get('pull', False)
+        concurrency = job['kwargs'].get('concurrency') or \
+            ModelImporter.model('setting').get(
+                PluginSettings.INGEST_CONCURRENCY)
+
+        errorState = False
+
+        jobLog.flush(
+            log='Started to refresh Docker images\n',
+            status=JobStatus.RUNNING,
+        )
+
+        try:
+            docker_client = getDockerClient()
+
+        except docker.errors.DockerException as err:
+            logger.exception('Could not create the docker client')
+            jobLog.updateJob(
+                job,
+                log='Failed to create the Docker Client\n' + str(err) + '\n',
+            )
+            raise DockerImageError('Could not create the docker client')
+
+        reapMetadataContainers(docker_client)
+
+        imageModel = ModelImporter.model('docker_image_model',
+                                         'slicer_cli_web_ssr')
+        storedIds = imageModel.getImageIds(refreshList)
+        notRegistered = [name for name in refreshList if name not in storedIds]
+        if notRegistered:
+            jobLog.updateJob(
+                job,
+                log='The following images are not registered\n' +
+                    '\n'.join(notRegistered) + '\n',
+            )
+
+        if pull:
+            try:
+                pullDockerImage(docker_client, list(storedIds),
+                                PullProgress(jobLog, job), int(concurrency))
+            except DockerImageNotFoundError as err:
+                errorState = True
+                jobLog.updateJob(
+                    job,
+                    log='could not pull the following '
+                        'images\n' + '\n'.join(err.imageName) + '\n',
+                )
+
+        changed = []
+        for name in refreshList:
+            if name not in storedIds:
+                continue
+            try:
+                currentId = docker_client.images.get(name).id
+            except Exception:
+                errorState = True
+                jobLog.updateJob(
+                    job,
+                    log='Image %s no longer exists locally\n' % name,
+                )
+                continue
+            if currentId != storedIds[name]:
+                changed.append(name)
+        jobLog.updateJob(
             job,
+            log='%d of %d images changed\n%s' % (
+                len(changed), len(storedIds),
+                ''.join(name + '\n' for name in changed)),
+        )
+
+        loadingError = False
+        if changed:
+            if int(concurrency) > 1 and len(changed) > 1:
+                cache, loadingError = LoadMetadataConcurrently(
+                    jobLog, job, docker_client, [], changed, int(concurrency))
+            else:
+                cache, loadingError = LoadMetadata(
+                    jobLog, job, docker_client, [], changed, set())
+            imageModel.saveAllImgs(cache)
+        if errorState is False and loadingError is False:
+            newStatus = JobStatus.SUCCESS
+        else:
+            newStatus = JobStatus.ERROR
+        jobLog.flush(
+            log='Finished refreshing Docker image data\n',
+            status=newStatus,
+            notify=True,
+            progressMessage='Completed refreshing docker images'
+        )
+    except Exception as err:
+
+        logger.exception('Error with job')
+        jobLog.flush(
             log='Error with job \n ' + str(err) + '\n',
             status=JobStatus.ERROR,
         )
@@ -254,35 +388,161 @@ def LoadMetadata(jobModel, job, docker_client, pullList, loadList, notExistSet):
     return cache, errorState
 
 
-def getDockerOutput(imgName, command, client):
+def _ingestImage(jobModel, job, docker_client, name, pull, progress=None):
+    """
+    Pull (if requested) and query a single image for its cli data.  This is
+    run on a worker thread by LoadMetadataConcurrently.
+
+    :param progress: a PullProgress object used to report pull progress.
+    :returns: a tuple of the image name, the DockerImage object or None if the
+        image could not be ingested, and a boolean that is True if the image
+        could not be pulled.
+    """
+    if pull:
+        try:
+            pullDockerImage(docker_client, [name], progress)
+        except DockerImageNotFoundError:
+            return name, None, True
+        jobModel.updateJob(
+            job,
+            log='Image %s was pulled successfully \n' % name,
+        )
+    try:
+        dockerImg = DockerImage(name)
+        getCliData(name, docker_client, dockerImg, jobModel, job)
+        jobModel.updateJob(
+            job,
+            log='Got %s image %s metadata \n' % (
+                'pulled' if pull else 'pre-existing', name)
+        )
+        return name, dockerImg, False
+    except Exception as err:
+        jobModel.updateJob(
+            job,
+            log='Error with image %s\n%s\n' % (name, err),
+        )
+    return name, None, False
+
+
+def LoadMetadataConcurrently(jobModel, job, docker_client, pullList,
+                             loadList, concurrency):
+    """
+    Pull and query images in parallel.  Each image is pulled, inspected and
+    has its cli xml extracted independently of the others by a pool of at
+    most `concurrency` threads.  Results are merged into a single DockerCache
+    once every image has been handled.
+
+    :param jobModel: A JobLogBuffer (or other thread safe object with an
+        updateJob method) used to update job status
+    :param job: The current job being executed
+    :param docker_client: An instance of the Docker python client
+    :param pullList: The list of images to pull and then query
+    :param loadList: The list of images to be queried that were already on the
+        local machine
+    :param concurrency: The maximum number of images handled at once
+
+    :returns: DockerCache Object containing cli information for each image
+        and a boolean indicating whether an error occurred
+    """
+    tasks = [(name, True) for name in pullList] + \
+        [(name, False) for name in loadList if name not in pullList]
+    progress = PullProgress(jobModel, job)
+
+    pool = ThreadPool(min(concurrency, len(tasks)))
+    try:
+        results = pool.map(
+            lambda task: _ingestImage(jobModel, job, docker_client,
+                                      task[0], task[1], progress),
+            tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    cache = DockerCache()
+    errorState = False
+    notExist = []
+    for name, dockerImg, notFound in results:
+        if notFound:
+            notExist.append(name)
+        elif dockerImg is None:
+            errorState = True
+        else:
+            cache.addImage(dockerImg)
+    if notExist:
+        errorState = True
+        jobModel.updateJob(
+            job,
+            log='could not find the following '
+                'images\n' + '\n'.join(notExist) + '\n',
+        )
+    return cache, errorState
+
+
+def _getMetadataContainerLimits():
+    """
+    Get the deadline and resource limits applied to metadata containers from
+    the plugin settings.
+
+    :returns: a dictionary with the timeout in seconds, the memory limit and
+        the cpu limit in units of 1e-9 cpus.
+    """
+    settingModel = ModelImporter.model('setting')
+    return {
+        'timeout': int(settingModel.get(
+            PluginSettings.METADATA_CONTAINER_TIMEOUT)),
+        'mem_limit': settingModel.get(
+            PluginSettings.METADATA_CONTAINER_MEMORY),
+        'nano_cpus': int(float(settingModel.get(
+            PluginSettings.METADATA_CONTAINER_CPUS)) * 1e9),
+    }
+
+
+def getDockerOutput(imgName, command, client, limits=None):
     """
     Data from each docker image is collected by executing the equivalent of a
     docker run <imgName> <command/args>
-    and collecting the output to standard output
+    and collecting the output to standard output.  The container runs with
+    memory and cpu limits and is killed if it does not finish before the
+    deadline.  It is always removed afterwards.
     :param imgName: The name of the docker image
     :param command: The commands/ arguments to be passed to the docker image
     :param client: The docker python client
+    :param limits: a dictionary with the timeout, mem_limit and nano_cpus to
+        use.  If None, these are read from the plugin settings.
     """
+    if limits is None:
+        limits = _getMetadataContainerLimits()
     cont = None
     try:
-        cont = client.containers.create(image=imgName, command=command)
+        cont = client.containers.create(
+            image=imgName, command=command,
+            labels={METADATA_CONTAINER_LABEL: 'true'},
+            mem_limit=limits['mem_limit'], nano_cpus=limits['nano_cpus'])
         cont.start()
-        ret_code = cont.wait()
+        try:
+            ret_code = cont.wait(timeout=limits['timeout'])
+        except (requests.exceptions.ReadTimeout,
+                requests.exceptions.ConnectionError):
+            raise DockerImageError(
+                'Attempt to docker run %s %s did not finish within %d '
+                'seconds' % (imgName, command, limits['timeout']), imgName)
 
         logs = cont.logs(stdout=True, stderr=False, stream=False)
-
-        cont.remove()
+    except DockerImageError:
+        raise
     except Exception as err:
-        if cont:
-            try:
-                cont.remove()
-            except Exception:
-                pass
         logger.exception(
             'Attempt to docker run %s %s failed', imgName, command)
         raise DockerImageError(
             'Attempt to docker run %s %s failed ' % (
                 imgName, command) + str(err), imgName)
+    finally:
+        if cont:
+            try:
+                # force kills the container if it is still running
+                cont.remove(force=True)
+            except Exception:
+                logger.exception('Could not remove container %s', cont.id)
     # 06/19/2018 ret_code is object instead of a value may caused by package version
     # if ret_code != 0:
     if ret_code['StatusCode'] != 0:
@@ -291,24 +551,225 @@ def getDockerOutput(imgName, command, client):
     return logs
 
 
-def getCliData(name, client, img, jobModel, job):
+def reapMetadataContainers(client, maxAge=None):
+    """
+    Remove metadata containers that were left behind, for instance by a job
+    that crashed or by a server that was stopped during ingestion.
+
+    :param client: The docker python client
+    :param maxAge: only containers created more than this many seconds ago
+        are removed, so that containers of ingestion jobs that are still
+        running are left alone.  If None, twice the metadata container
+        timeout is used.
+    :returns: the number of containers removed.
+    """
+    if maxAge is None:
+        maxAge = 2 * _getMetadataContainerLimits()['timeout']
+    removed = 0
     try:
+        containers = client.api.containers(
+            all=True, filters={'label': METADATA_CONTAINER_LABEL})
+    except Exception:
+        logger.exception('Could not list metadata containers')
+        return removed
+    for cont in containers:
+        if cont.get('Created', 0) > time.time() - maxAge:
+            continue
+        try:
+            client.api.remove_container(cont['Id'], force=True)
+            removed += 1
+        except Exception:
+            logger.exception('Could not remove metadata container %s',
+                             cont['Id'])
+    if removed:
+        logger.info('Removed %d orphaned metadata containers', removed)
+    return removed
 
-        if isinstance(client, docker.DockerClient) and isinstance(img, DockerImage):
 
-            cli_dict = getDockerOutput(name, '--list_cli', client)
+def getBulkCliData(name, client, limits=None):
+    """
+    Attempt to get the cli list and the xml spec of every cli of an image in a
+    single container run using ``--list_cli --with-xml``.  Images whose
+    entrypoint does not support the flag either fail or return the plain cli
+    list; in the later case the clis are returned without xml.
 
-            cli_dict = json.loads(cli_dict)
+    :param name: The name of the docker image
+    :param client: The docker python client
+    :param limits: the metadata container limits passed to getDockerOutput.
+    :returns: the cli dictionary, or None if the image could not be queried
+        this way.
+    """
+    try:
+        cli_dict = json.loads(getDockerOutput(
+            name, '--list_cli %s' % BULK_XML_FLAG, client, limits))
+    except (DockerImageError, ValueError):
+        logger.info('Image %s does not support %s', name, BULK_XML_FLAG)
+        return None
+    if not isinstance(cli_dict, dict):
+        return None
+    return cli_dict
 
-            for (key, val) in iteritems(cli_dict):
 
-                cli_xml = getDockerOutput(name, '%s --xml' % key, client)
-                cli_dict[key][DockerImage.xml] = cli_xml
+def _readFileFromContainer(cont, path):
+    """
+    Read a single file out of a container's filesystem via the docker archive
+    api.  The container does not need to be running.
+
+    :param cont: a docker container object.
+    :param path: the absolute path of the file in the container.
+    :returns: the contents of the file, or None if it does not exist.
+    """
+    try:
+        stream, stat = cont.get_archive(path)
+    except docker.errors.NotFound:
+        return None
+    if stat.get('mode', 0) & 0o20000000000:
+        # the path is a directory
+        return None
+    archive = tarfile.open(fileobj=six.BytesIO(b''.join(stream)))
+    for member in archive.getmembers():
+        if member.isfile():
+            data = archive.extractfile(member).read()
+            return data.decode('utf8')
+    return None
+
+
+def getStaticCliData(name, client):
+    """
+    Read the cli list spec and each cli's <cli>/<cli>.xml file straight from
+    the image filesystem.  A container is created so its filesystem can be
+    read, but it is never started, so neither the container startup nor the
+    entrypoint's imports are paid.
+
+    :param name: The name of the docker image
+    :param client: The docker python client
+    :returns: the cli dictionary, with an xml entry for each cli that has a
+        static xml file, or None if the image has no static cli list spec.
+    """
+    cont = None
+    try:
+        image = client.images.get(name)
+        workDir = image.attrs.get('Config', {}).get('WorkingDir') or '/'
+        cont = client.containers.create(
+            image=name, command='--list_cli',
+            labels={METADATA_CONTAINER_LABEL: 'true'})
+        cli_dict = None
+        for specFile in CLI_LIST_SPEC_FILES:
+            spec = _readFileFromContainer(
+                cont, posixpath.join(workDir, specFile))
+            if spec is not None:
+                cli_dict = json.loads(spec)
+                break
+        if not isinstance(cli_dict, dict):
+            return None
+        for (key, val) in iteritems(cli_dict):
+            cliPath = posixpath.normpath(key)
+            cli_xml = _readFileFromContainer(cont, posixpath.join(
+                workDir, cliPath, os.path.basename(cliPath) + '.xml'))
+            if cli_xml is not None:
+                val[DockerImage.xml] = cli_xml
+        return cli_dict
+    except Exception:
+        logger.exception('Could not read static cli data from image %s', name)
+        return None
+    finally:
+        if cont:
+            try:
+                cont.remove(force=True)
+            except Exception:
+                pass
+
+
+def getCliData(name, client, img, jobModel, job, mode=None):
+    """
+    Collect the cli list and each cli's xml spec from an image and add them
+    to the DockerImage object.  In 'static' mode the data is read from the
+    image filesystem first; otherwise, or if the image has no static cli
+    list, the image is asked for everything in one run and finally queried
+    one cli at a time.  Only clis that are still missing xml are run with
+    --xml.
+
+    :param name: The name of the docker image
+    :param client: The docker python client
+    :param img: The DockerImage object to add the clis to
+    :param jobModel: Singleton JobModel used to update job status
+    :param job: The current job being executed
+    :param mode: one of METADATA_EXTRACTION_MODES.  If None, the
+        slicer_cli_web_ssr.metadata_extraction setting is used.
+    :returns: the cli dictionary
+
+    Metadata is keyed by the docker image id: if another name that resolves
+    to the same image id was already ingested, its cli data is reused and no
+    container is created.
+    """
+    try:
+
+        if isinstance(client, docker.DockerClient) and isinstance(img, DockerImage):
+
+            img.setImageId(client.images.get(name).id)
+            imageModel = ModelImporter.model('docker_image_model',
+                                             'slicer_cli_web_ssr')
+            aliasOf, cli_dict = imageModel.getCliDataByImageId(
+                img.getImageId())
+            if cli_dict is not None:
+                for (key, val) in iteritems(cli_dict):
+                    img.addCLI(key, val)
                 jobModel.updateJob(
                     job,
-                    log='Got image %s, cli %s metadata\n' % (name, key),
+                    log='Reused image %s cli metadata from %s (image id '
+                        '%s)\n' % (name, aliasOf, img.getImageId()),
                     status=JobStatus.RUNNING,
                 )
+                return cli_dict
+
+            if mode is None:
+                mode = ModelImporter.model('setting').get(
+                    PluginSettings.METADATA_EXTRACTION)
+            cli_dict = None
+            if mode == 'static':
+                cli_dict = getStaticCliData(name, client)
+                if cli_dict is not None:
+                    jobModel.updateJob(
+                        job,
+                        log='Read image %s cli list and %d static xml specs '
+                            'without running it\n' % (name, len([
+                                key for key in cli_dict
+                                if DockerImage.xml in cli_dict[key]])),
+                        status=JobStatus.RUNNING,
+                    )
+            limits = _getMetadataContainerLimits()
+            if cli_dict is None:
+                cli_dict = getBulkCliData(name, client, limits)
+                if cli_dict is not None:
+                    jobModel.updateJob(
+                        job,
+                        log='Got image %s cli list with %d xml specs in a '
+                            'single run\n' % (name, len([
+                                key for key in cli_dict
+                                if DockerImage.xml in cli_dict[key]])),
+                        status=JobStatus.RUNNING,
+                    )
+            if cli_dict is None:
+                cli_dict = getDockerOutput(name, '--list_cli', client, limits)
+
+                cli_dict = json.loads(cli_dict)
+
+            for (key, val) in iteritems(cli_dict):
+
+                if DockerImage.xml in val:
+                    cli_xml = val[DockerImage.xml]
+                else:
+                    cli_xml = getDockerOutput(name, '%s --xml' % key, client,
+                                              limits)
+                    jobModel.updateJob(
+                        job,
+                        log='Got image %s, cli %s metadata\n' % (name, key),
+                        status=JobStatus.RUNNING,
+                    )
+                cli_dict[key] = {
+                    DockerImage.type: val[DockerImage.type],
+                    DockerImage.xml: cli_xml,
+                }
                 img.addCLI(key, cli_dict[key])
         return cli_dict
     except Exception as err:
@@ -318,24 +779,103 @@ def getCliData(name, client, img, jobModel, job):
             'Error getting %s cli data from image %s ' % (name, img) + str(err))
 
 
-def pullDockerImage(client, names):
+class PullProgress(object):
+    """
+    Aggregates the per-layer download progress of one or more streaming
+    pulls into the job's progressTotal and progressCurrent (in bytes).  Job
+    updates go through the job model passed in, which is expected to be a
+    JobLogBuffer so that the frequent progress events are throttled before
+    they reach mongo.
+    """
+    def __init__(self, jobModel, job):
+        self.jobModel = jobModel
+        self.job = job
+        self.lock = threading.Lock()
+        # (image name, layer id): [bytes downloaded, layer size]
+        self.layers = {}
+
+    def update(self, name, event):
+        """
+        Record one event of a streaming pull.
+
+        :param name: the name of the image being pulled.
+        :param event: a decoded status event from the docker pull stream.
+        """
+        layer = event.get('id')
+        status = event.get('status', '')
+        detail = event.get('progressDetail') or {}
+        if not layer:
+            return
+        with self.lock:
+            entry = self.layers.setdefault((name, layer), [0, 0])
+            if status == 'Downloading' and detail.get('total'):
+                entry[0] = detail.get('current', 0)
+                entry[1] = detail['total']
+            elif status in ('Download complete', 'Pull complete',
+                            'Already exists'):
+                entry[0] = entry[1]
+            else:
+                return
+            current = sum(val[0] for val in self.layers.values())
+            total = sum(val[1] for val in self.layers.values())
+        self.jobModel.updateJob(
+            self.job,
+            progressTotal=total,
+            progressCurrent=current,
+            progressMessage='Pulled %.1f of %.1f MB' % (
+                current / 1048576.0, total / 1048576.0),
+        )
+
+
+def _pullImage(client, name, progress=None):
+    """
+    Pull a single image using the streaming pull api, reporting the download
+    progress of each layer.
+
+    :params client: The docker python client
+    :params name: The docker image to be pulled.
+    :params progress: a PullProgress object or None.
+    :returns: True if the image was pulled.
+    """
+    try:
+        for event in client.api.pull(name, stream=True, decode=True):
+            if 'error' in event:
+                logger.error('Failed to pull %s: %s', name, event['error'])
+                return False
+            if progress is not None:
+                progress.update(name, event)
+        # some invalid image names will not be pulled but the pull method
+        # will not throw an exception so the only way to confirm if a pull
+        # succeeded is to attempt a docker inspect on the image
+        client.images.get(name)
+    except Exception:
+        logger.exception('Failed to pull %s', name)
+        return False
+    return True
+
+
+def pullDockerImage(client, names, progress=None, concurrency=1):
     """
     Attempt to pull the docker images listed in names. Failure results in a
     DockerImageNotFoundError being raised
 
     :params client: The docker python client
     :params names: A list of docker images to be pulled from the Dockerhub
+    :params progress: a PullProgress object used to report the download
+        progress on the job, or None.
+    :params concurrency: the maximum number of images pulled at once.
     """
-    imgNotExistList = []
-    for name in names:
+    if concurrency > 1 and len(names) > 1:
+        pool = ThreadPool(min(concurrency, len(names)))
         try:
-            client.images.pull(name)
-            # some invalid image names will not be pulled but the pull method
-            # will not throw an exception so the only way to confirm if a pull
-            # succeeded is to attempt a docker inspect on the image
-            client.images.get(name)
-        except Exception:
-            imgNotExistList.append(name)
+            pulled = pool.map(
+                lambda name: _pullImage(client, name, progress), names)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        pulled = [_pullImage(client, name, progress) for name in names]
+    imgNotExistList = [name for name, ok in zip(names, pulled) if not ok]
     if len(imgNotExistList) != 0:
         raise DockerImageNotFoundError('Could not find multiple images ',
                                        image_name=imgNotExistList)
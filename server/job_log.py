@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import threading
+import time
+
+
+class JobLogBuffer(object):
+    """
+    Accumulates job log lines and job field changes (status, progress, ...)
+    and writes them to the job with a single jobModel.updateJob call once
+    enough lines are pending, once enough time has passed since the last
+    write, or when flush is called.  Every updateJob call is a database write
+    and fires a jobs.job.update.after event, so batching them keeps
+    ingestion of images with many clis from flooding mongo and the event
+    listeners.
+
+    updateJob has the same signature as the job model's, so an instance can
+    be passed anywhere a job model is used to report progress.  It is safe to
+    use from multiple threads.
+    """
+
+    def __init__(self, jobModel, job, interval=2.0, maxLines=50):
+        """
+        :param jobModel: the job model used to write updates.
+        :param job: the job to update.
+        :param interval: the maximum number of seconds pending updates are
+            held before they are written.
+        :param maxLines: the maximum number of pending log lines held before
+            they are written.
+        """
+        self.jobModel = jobModel
+        self.job = job
+        self.interval = interval
+        self.maxLines = maxLines
+        self._lock = threading.Lock()
+        self._lines = []
+        self._fields = {}
+        self._lastFlush = time.time()
+
+    def updateJob(self, job=None, log=None, **kwargs):
+        """
+        Queue a log line and/or field changes.  Later field values replace
+        earlier pending ones, so only the latest status is written.
+
+        :param job: ignored; present for compatibility with the job model.
+        :param log: a log line to append.
+        :param kwargs: other arguments to jobModel.updateJob.
+        :returns: the job.
+        """
+        with self._lock:
+            self._queue(log, kwargs)
+            if (len(self._lines) >= self.maxLines or
+                    time.time() - self._lastFlush >= self.interval):
+                self._flush()
+            return self.job
+
+    def flush(self, log=None, **kwargs):
+        """
+        Queue an optional final log line and field changes, then write
+        everything that is pending.
+
+        :returns: the job.
+        """
+        with self._lock:
+            self._queue(log, kwargs)
+            self._flush()
+            return self.job
+
+    def _queue(self, log, kwargs):
+        if log:
+            self._lines.append(log)
+        for key, value in kwargs.items():
+            if value is not None:
+                self._fields[key] = value
+
+    def _flush(self):
+        if self._lines or self._fields:
+            kwargs = self._fields
+            self._fields = {}
+            if self._lines:
+                kwargs['log'] = ''.join(self._lines)
+                self._lines = []
+            self.job = self.jobModel.updateJob(self.job, **kwargs) or self.job
+        self._lastFlush = time.time()
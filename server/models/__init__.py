@@ -1,8 +1,9 @@
 from .docker_image import DockerImage, DockerCache, DockerImageStructure,  \
     DockerImageError, DockerImageNotFoundError
+from .cli_xml_spec import CliXmlSpec
 from .docker_image_model import DockerImageModel
 
 
-__all__ = ('DockerImage', 'DockerImageModel', 'DockerCache',
+__all__ = ('CliXmlSpec', 'DockerImage', 'DockerImageModel', 'DockerCache',
            'DockerImageError', 'DockerImageNotFoundError',
            'DockerImageStructure')
@@ -0,0 +1,193 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import datetime
+import hashlib
+import zlib
+from bson.binary import Binary
+from pymongo import UpdateOne
+from six import iteritems, text_type
+
+from girder import logger
+from girder.models.model_base import Model, ModelImporter
+
+from .docker_image import DockerImage, DockerImageError
+
+
+class CliXmlSpec(Model):
+    """
+    Stores the xml spec of each cli once, keyed by the sha256 of its content.
+    Image documents only reference specs by hash, so listing images does not
+    read any xml, and images (or tags of one image) that ship identical clis
+    share a single copy.  Specs are immutable: a changed xml has a different
+    hash and is stored as a new document.
+
+    Specs are verbose and repetitive, so they are stored zlib compressed.
+    Specs stored uncompressed by earlier versions are compressed the first
+    time they are read.
+    """
+    xmlHash = 'xmlhash'
+    xml = 'xml'
+    # the compression of the stored xml; absent for uncompressed specs
+    compression = 'compression'
+    # when an image document being written last referenced the spec
+    updated = 'updated'
+    # unreferenced specs are kept this long after they were last referenced,
+    # so that an image document that is about to be written can still use them
+    gracePeriod = datetime.timedelta(hours=1)
+
+    def initialize(self):
+        self.name = 'cli_xml_spec'
+        self.ensureIndices([(self.xmlHash, {'unique': True})])
+
+    @staticmethod
+    def getHashKey(xml):
+        """
+        :param xml: the xml spec of a cli
+        :returns: the hash the spec is stored under, as a string
+        """
+        if isinstance(xml, text_type):
+            xml = xml.encode('utf8')
+        return hashlib.sha256(xml).hexdigest()
+
+    @staticmethod
+    def _compress(xml):
+        if isinstance(xml, text_type):
+            xml = xml.encode('utf8')
+        return Binary(zlib.compress(xml))
+
+    @staticmethod
+    def _decompress(data):
+        return zlib.decompress(bytes(data)).decode('utf8')
+
+    def storeXML(self, specs, referenced=()):
+        """
+        Store xml specs that are not stored yet and mark them, and any other
+        specs that are referenced, as just referenced, in a single bulk write.
+
+        :param specs: a dictionary of {hash: xml}, with the hashes from
+            getHashKey.
+        :param referenced: hashes of specs that are already stored.
+        :raises DockerImageError: if a referenced spec is not stored.
+        """
+        now = datetime.datetime.utcnow()
+        others = set(referenced).difference(specs)
+        requests = [
+            UpdateOne({self.xmlHash: xmlHash},
+                      {'$setOnInsert': {self.xmlHash: xmlHash,
+                                        self.xml: self._compress(xml),
+                                        self.compression: 'zlib'},
+                       '$set': {self.updated: now}},
+                      upsert=True)
+            for (xmlHash, xml) in iteritems(specs)]
+        requests.extend(UpdateOne({self.xmlHash: xmlHash},
+                                  {'$set': {self.updated: now}})
+                        for xmlHash in others)
+        if not requests:
+            return
+        try:
+            result = self.collection.bulk_write(requests, ordered=False)
+        except Exception as err:
+            logger.exception('Could not save cli xml specs')
+            raise DockerImageError(
+                'Could not save cli xml specs to database ' + str(err))
+        if result.matched_count + result.upserted_count < len(requests):
+            missing = others.difference(self.collection.distinct(
+                self.xmlHash, {self.xmlHash: {'$in': list(others)}}))
+            raise DockerImageError('No cli xml spec with the hashes %s' %
+                                   ', '.join(sorted(missing)))
+
+    def getXML(self, xmlHash):
+        """
+        :param xmlHash: the hash of a stored xml spec.
+        :returns: the xml spec.
+        :raises DockerImageError: if no spec is stored under the hash.
+        """
+        doc = self.collection.find_one({self.xmlHash: xmlHash})
+        if doc is None:
+            raise DockerImageError('No cli xml spec with the hash %s' %
+                                   xmlHash)
+        if doc.get(self.compression) == 'zlib':
+            return self._decompress(doc[self.xml])
+        xml = doc[self.xml]
+        try:
+            self.collection.update_one(
+                {'_id': doc['_id'], self.compression: {'$exists': False}},
+                {'$set': {self.xml: self._compress(xml),
+                          self.compression: 'zlib'}})
+        except Exception:
+            logger.exception('Could not compress the cli xml spec %s',
+                             xmlHash)
+        return xml
+
+    def getXMLs(self, xmlHashes):
+        """
+        Get several xml specs with a single query.
+
+        :param xmlHashes: a list of hashes of stored xml specs.
+        :returns: a dictionary of {hash: xml spec} of the specs that were
+            found.
+        """
+        specs = {}
+        for doc in self.collection.find(
+                {self.xmlHash: {'$in': list(xmlHashes)}}):
+            if doc.get(self.compression) == 'zlib':
+                specs[doc[self.xmlHash]] = self._decompress(doc[self.xml])
+            else:
+                specs[doc[self.xmlHash]] = doc[self.xml]
+        return specs
+
+    def removeUnreferenced(self, xmlHashes=None, gracePeriod=None):
+        """
+        Remove stored specs that no image document references any more and
+        that were not referenced within the grace period.
+
+        :param xmlHashes: the hashes of the specs that may have become
+            unreferenced, e.g., those of removed images, or None to check all
+            specs.
+        :param gracePeriod: a timedelta, or None to use the class default.
+        """
+        if gracePeriod is None:
+            gracePeriod = self.gracePeriod
+        # specs saved before the field existed have no updated time
+        stale = {self.updated: {
+            '$not': {'$gte': datetime.datetime.utcnow() - gracePeriod}}}
+        query = dict(stale)
+        if xmlHashes is not None:
+            xmlHashes = list(set(xmlHashes))
+            if not xmlHashes:
+                return
+            query[self.xmlHash] = {'$in': xmlHashes}
+        candidates = self.collection.distinct(self.xmlHash, query)
+        if not candidates:
+            return
+        imageCollection = ModelImporter.model(
+            'docker_image_model', 'slicer_cli_web_ssr').collection
+        referenced = set(imageCollection.distinct(
+            DockerImage.xmlHashes, {DockerImage.xmlHashes: {'$in': candidates}}))
+        unreferenced = [xmlHash for xmlHash in candidates
+                        if xmlHash not in referenced]
+        if unreferenced:
+            # a spec referenced again since the query is kept
+            query = dict(stale)
+            query[self.xmlHash] = {'$in': unreferenced}
+            self.collection.delete_many(query)
+
+    def validate(self, doc):
+        return doc
@@ -23,6 +23,7 @@ import hashlib
 import jsonschema
 
 from girder import logger
+from girder.models.model_base import ModelImporter
 
 
 class DockerImageError(Exception):
@@ -56,11 +57,32 @@ class DockerImage():
     # keys used by the dictionary that stores metadata on the image
     imageName = 'docker_image_name'
     imageHash = 'imagehash'
+    # the id the docker engine assigned to the image the name resolved to when
+    # its metadata was extracted
+    imageId = 'image_id'
     type = 'type'
     xml = 'xml'
+    # once saved, the xml of each cli is kept in the cli_xml_spec collection
+    # and the cli entry holds its hash instead
+    xmlHash = 'xmlhash'
+    # the hashes of all the image's cli xml specs, so the specs an image
+    # references can be queried without knowing its cli names
+    xmlHashes = 'xml_hashes'
+    # changes every time the image metadata is saved, so that girder
+    # processes can tell which images changed since they built their
+    # endpoints
+    revision = 'revision'
     cli_dict = 'cli_list'
 
-    def __init__(self, name):
+    def __init__(self, name, validate=True):
+        """
+        :param name: the docker image name, or a dictionary of image metadata
+            as returned by getRawData.
+        :param validate: if False, a metadata dictionary is trusted and not
+            validated against the image schema.  Use this for data that was
+            validated before, such as documents read from the database or the
+            data of another DockerImage.
+        """
         try:
             if isinstance(name, string_types):
 
@@ -73,7 +95,8 @@ class DockerImage():
                 self.name = name
                 # TODO check/validate schema of dict
             elif isinstance(name, dict):
-                jsonschema.validate(name, DockerImageStructure.ImageSchema)
+                if validate:
+                    DockerImageStructure.validator.validate(name)
                 self.data = name.copy()
                 self.name = self.data[DockerImage.imageName]
                 self.hash = DockerImage.getHashKey(self.name)
@@ -97,11 +120,29 @@ class DockerImage():
                       xml: < xml >
 
                     }
+                    or with xmlhash: < hash of a stored xml spec > in
+                    place of the xml
         The data is passed in a s a dictionary in the case the more metadata
         is added to eh cli description
         """
         self.data[DockerImage.cli_dict][cli_name] = cli_data
 
+    def setImageId(self, imageId):
+        """
+        Record the docker image id the image name resolved to when the cli
+        metadata was collected.  Names that resolve to the same id share
+        their cli metadata.
+        :param imageId: the docker image id (sha256:...)
+        """
+        self.data[DockerImage.imageId] = imageId
+
+    def getImageId(self):
+        """
+        :returns: the docker image id recorded for this image, or None if the
+            metadata was collected before image ids were recorded.
+        """
+        return self.data.get(DockerImage.imageId)
+
     @staticmethod
     def getHashKey(imgName):
         """
@@ -118,14 +159,42 @@ class DockerImage():
         return imageKey
 
     def getCLIXML(self, cli):
-
+        """
+        Get the xml spec of a cli.  Images loaded from the database only hold
+        the hash of each spec, in which case the spec is read from the
+        cli_xml_spec collection.
+        :param cli: the name of the cli
+        :returns: the xml spec as a string
+        """
         if cli in self.data[DockerImage.cli_dict]:
-            return self.data[DockerImage.cli_dict][cli][DockerImage.xml]
+            val = self.data[DockerImage.cli_dict][cli]
+            if DockerImage.xml in val:
+                return val[DockerImage.xml]
+            return ModelImporter.model(
+                'cli_xml_spec', 'slicer_cli_web_ssr').getXML(
+                val[DockerImage.xmlHash])
 
         else:
             raise DockerImageError('No cli named %s in the '
                                    'image %s' % (cli, self.name))
 
+    def getCLIXMLHash(self, cli):
+        """
+        Get the content hash of the xml spec of a cli, without reading the
+        spec if it is stored in the cli_xml_spec collection.
+        :param cli: the name of the cli
+        :returns: the hash as a string
+        """
+        if cli not in self.data[DockerImage.cli_dict]:
+            raise DockerImageError('No cli named %s in the '
+                                   'image %s' % (cli, self.name))
+        val = self.data[DockerImage.cli_dict][cli]
+        if DockerImage.xmlHash in val:
+            return val[DockerImage.xmlHash]
+        return ModelImporter.model(
+            'cli_xml_spec', 'slicer_cli_web_ssr').getHashKey(
+            val[DockerImage.xml])
+
     def getCLIListSpec(self):
         """
         Returns a dictionary in the format of slicer_cli_list.json
@@ -143,6 +212,21 @@ class DockerImage():
             spec_dict[key] = val[DockerImage.type]
         return spec_dict
 
+    def getRevision(self):
+        """
+        :returns: the revision of the saved image metadata, or None if the
+            metadata has not been saved.
+        """
+        return self.data.get(DockerImage.revision)
+
+    def hasInlineXML(self):
+        """
+        :returns: True if any cli of the image holds its xml spec rather than
+            a reference to the cli_xml_spec collection.
+        """
+        return any(DockerImage.xml in val for val in
+                   self.data[DockerImage.cli_dict].values())
+
     def getRawData(self):
         return self.data
 
@@ -169,7 +253,9 @@ class DockerCache:
         """
         try:
             if isinstance(img, DockerImage):
-                self.data[img.hash] = DockerImage(img.getRawData())
+                # the data is validated when it is written to the database
+                self.data[img.hash] = DockerImage(img.getRawData(),
+                                                  validate=False)
             else:
                 raise DockerImageError('Tried to add a non '
                                        'docker image object to cache')
@@ -245,9 +331,13 @@ class DockerImageStructure:
         'type': 'object',
         "properties": {
             DockerImage.type: {'type': 'string'},
-            DockerImage.xml: {'type': 'string'}
+            DockerImage.xml: {'type': 'string'},
+            DockerImage.xmlHash: {'type': 'string'}
         },
-        'required': [DockerImage.type, DockerImage.xml],
+        'required': [DockerImage.type],
+        # either the xml spec or the hash it is stored under
+        'anyOf': [{'required': [DockerImage.xml]},
+                  {'required': [DockerImage.xmlHash]}],
         'additionalProperties': False
     }
 
@@ -269,6 +359,10 @@ class DockerImageStructure:
         'properties': {
             DockerImage.imageName: {'type': 'string'},
             DockerImage.imageHash: {'type': 'string'},
+            DockerImage.imageId: {'type': 'string'},
+            DockerImage.revision: {'type': 'string'},
+            DockerImage.xmlHashes: {'type': 'array',
+                                    'items': {'type': 'string'}},
             DockerImage.cli_dict: cli_list_schema
 
         },
@@ -277,3 +371,7 @@ class DockerImageStructure:
         'additionalProperties': True
 
     }
+
+    # jsonschema.validate checks the schema and builds a new validator on
+    # every call, so build the validator once and reuse it
+    validator = jsonschema.validators.validator_for(ImageSchema)(ImageSchema)
@@ -17,18 +17,30 @@
 #  limitations under the License.
 ###############################################################################
 
+import datetime
 import docker
-from girder import logger
+import threading
+from bson.objectid import ObjectId
+from pymongo import ReplaceOne
+from pymongo.errors import DuplicateKeyError
+from six import iteritems
+
+from girder import events, logger
 from girder.constants import AccessType
 from girder.api.rest import getCurrentUser
 from girder.models.model_base import ModelImporter, AccessControlledModel
+from girder.plugins.jobs.constants import JobStatus
 
-import jsonschema
-
+from ..docker_client import getDockerClient, LocalImageIndex
 from ..models import DockerImage, DockerImageError, \
     DockerImageNotFoundError, DockerCache, DockerImageStructure
 
-# from six import iteritems
+# the kwargs of each ingestion job function that list the images it covers
+_INGEST_JOB_LISTS = {
+    'jobPullAndLoad': ('pullList', 'loadList'),
+    'jobRefresh': ('refreshList',),
+}
+
 # import os
 # from lxml import etree
 # from StringIO import StringIO
@@ -41,15 +53,22 @@ class DockerImageModel(AccessControlledModel):
     """
     # TODO reference by image id or require image:digest
     imageHash = DockerImage.imageHash
+    # an unfinished ingestion job not updated for this long is assumed to
+    # have died with its girder process and is not joined
+    activeJobTimeout = datetime.timedelta(minutes=30)
 
     def initialize(self):
         self.name = 'docker_image_model'
         # use the DockerImage.gethash as the id
-        self.ensureIndices([self.imageHash])
+        self.ensureIndices([self.imageHash, DockerImage.imageId])
         self.exposeFields(AccessType.ADMIN, (DockerImage.imageHash,))
-        self.versionId = None
+        # the memoized DockerCache is stamped with the registry version it
+        # was built from and is rebuilt when the version changes
+        self._versionLock = threading.Lock()
+        self._dockerCache = None
+        self._dockerCacheVersion = None
         try:
-            self.client = docker.from_env(version='auto')
+            self.client = getDockerClient()
         except docker.errors.DockerException as err:
             logger.exception('Could not create the docker client')
             raise DockerImageError('could not create the docker client ' + str(
@@ -69,23 +88,46 @@ class DockerImageModel(AccessControlledModel):
         :param pullIfNotLocal: Boolean if True, the job will attempt to pull
             the image from the default docker hub registry if it does not
             exist.
-        :returns: the job that was created.
+        :returns: the job that was created, or, if every image that needs to
+            be pulled or loaded is already being ingested by a job that has
+            not finished, that job.  A new job that only covers some of the
+            images lists the ids of the jobs ingesting the others in
+            meta.coalescedWith.
         """
         jobModel = ModelImporter.model('job', 'jobs')
         # list of images to pull and load
         pullList = []
         # list of images that exist locally and just need to be parsed and saved
         loadList = []
+        try:
+            localImages = LocalImageIndex(self.client)
+            local = set(name for name in names if localImages.exists(name))
+        except Exception as err:
+            logger.exception('Could not list the local docker images')
+            raise DockerImageError(
+                'Could not list the local docker images ' + str(err), names)
+        cached = set(doc[DockerImage.imageHash] for doc in self.collection.find(
+            {DockerImage.imageHash: {
+                '$in': [DockerImage.getHashKey(name) for name in names]}},
+            {DockerImage.imageHash: True}))
         for name in names:
-            try:
-                self._ImageExistsLocally(name)
-                data = self.collection.find_one(DockerImage.getHashKey(name))
-                if data is None:
+            if name in local:
+                if DockerImage.getHashKey(name) not in cached:
                     loadList.append(name)
-            # exception can be dockerimage
-            except DockerImageNotFoundError:
-                if pullIfNotLocal:
-                    pullList.append(name)
+            elif pullIfNotLocal:
+                pullList.append(name)
+
+        # images that an ingestion job that has not finished yet is already
+        # pulling or loading are not scheduled again
+        activeJobs, covered = self.findActiveIngestJobs(
+            pullList + loadList, jobType)
+        if activeJobs:
+            pullList = [name for name in pullList if name not in covered]
+            loadList = [name for name in loadList if name not in covered]
+            if not pullList and not loadList:
+                logger.info('Images %r are already being ingested by job %s',
+                            sorted(covered), activeJobs[0]['_id'])
+                return activeJobs[0]
 
         job = jobModel.createLocalJob(
             module='girder.plugins.slicer_cli_web_ssr.image_job',
@@ -100,48 +142,178 @@ class DockerImageModel(AccessControlledModel):
             public=True,
             async=True
         )
+        if activeJobs:
+            # point to the jobs that ingest the rest of the requested images
+            job.setdefault('meta', {})['coalescedWith'] = [
+                str(activeJob['_id']) for activeJob in activeJobs]
+            job = jobModel.save(job)
 
         jobModel.scheduleJob(job)
         return job
 
-    def _ImageExistsLocally(self, name):
+    def findActiveIngestJobs(self, names, jobType,
+                             functions=('jobPullAndLoad',)):
         """
-        Checks if the docker image exist locally
-        :param name: The name of the docker image
-
-        :returns id: returns the docker image id
+        Find the ingestion jobs that have not finished, were updated recently,
+        and that pull, load or refresh any of the given images.
+
+        :param names: a list of docker image names.
+        :param jobType: the type of the ingestion jobs.
+        :param functions: the job functions to consider, from
+            jobPullAndLoad and jobRefresh.
+        :returns: a tuple of the list of the jobs, oldest first, and the set
+            of the given names that they cover.
         """
-        try:
-            image = self.client.images.get(name)
-        except Exception as err:
-            logger.exception('Could not find docker image %s', name)
-            raise DockerImageNotFoundError(
-                'could not find the image \n' + str(err), name)
-        return image.id
+        if not names:
+            return [], set()
+        keys = sorted(set(key for function in functions
+                          for key in _INGEST_JOB_LISTS[function]))
+        jobModel = ModelImporter.model('job', 'jobs')
+        jobs = list(jobModel.find({
+            'type': jobType,
+            'function': {'$in': list(functions)},
+            'status': {'$in': [JobStatus.INACTIVE, JobStatus.QUEUED,
+                               JobStatus.RUNNING]},
+            'updated': {'$gte': datetime.datetime.utcnow() -
+                        self.activeJobTimeout},
+            '$or': [{'kwargs.' + key: {'$in': names}} for key in keys]
+        }, sort=[('created', 1)]))
+        covered = set()
+        for job in jobs:
+            for key in keys:
+                covered.update(job['kwargs'].get(key) or [])
+        return jobs, covered.intersection(names)
+
+    def refreshImages(self, names, jobType, pull=False):
+        """
+        Schedule a job that re-extracts cli metadata only for registered
+        images whose name now resolves to a different docker image id than
+        the one recorded when the metadata was extracted.
 
-    def save(self, img):
+        :param names: A list of registered docker image names, or None to
+            check every registered image.
+        :param jobType: defines the jobtype of the job that will be schedueled.
+            This can be used by event listeners to determine if a job succeeds.
+        :param pull: Boolean if True, each image is pulled before its image id
+            is compared, so tags that moved in the registry are picked up.
+        :returns: the job that was created.
         """
-        Attempt to save the docker image data in the mongo database
-        :param img: An instance of a dockerImage object
-        :type img: DockerImage
+        jobModel = ModelImporter.model('job', 'jobs')
+        if names is None:
+            names = self.collection.distinct(DockerImage.imageName)
 
+        job = jobModel.createLocalJob(
+            module='girder.plugins.slicer_cli_web_ssr.image_job',
+            function='jobRefresh',
+            kwargs={
+                'refreshList': names,
+                'pull': bool(pull)
+            },
+            title='Refreshing changed docker images',
+            type=jobType,
+            user=getCurrentUser(),
+            public=True,
+            async=True
+        )
+
+        jobModel.scheduleJob(job)
+        return job
+
+    def getImageIds(self, names):
         """
-        try:
-            # rely on the parent model class to add a '_id' field
-            super(DockerImageModel, self).save(document=img.getRawData(),
-                                               triggerEvents=True)
-        except Exception as err:
-            logger.exception('Could not save image %s metadata', img.name)
-            raise DockerImageError(
-                'Could not save image %s metadata '
-                'to database ' % img.name + str(err), img.name)
+        Get the docker image ids recorded for registered images.
 
-    def _load(self, imgHash):
+        :param names: a list of docker image names.
+        :returns: a dictionary of {name: image id} for each name that is
+            registered.  The id is None for metadata that was extracted before
+            image ids were recorded.
+        """
+        hashes = [DockerImage.getHashKey(name) for name in names]
+        return {
+            doc[DockerImage.imageName]: doc.get(DockerImage.imageId)
+            for doc in self.collection.find(
+                {DockerImage.imageHash: {'$in': hashes}},
+                {DockerImage.imageName: True, DockerImage.imageId: True})
+        }
+
+    def getCliDataByImageId(self, imageId):
+        """
+        Find cli metadata that was already extracted from a docker image id,
+        regardless of the name (tag or digest) it was registered under.  The
+        image documents map each registered name to the image id it resolved
+        to, so any alias of the same image can reuse the metadata.
+
+        :param imageId: the docker image id (sha256:...)
+        :returns: a tuple of the name the metadata was registered under and
+            its cli dictionary with the xml specs, or (None, None) if the
+            image id is unknown or its specs were removed.
+        """
+        if not imageId:
+            return None, None
+        doc = self.collection.find_one(
+            {DockerImage.imageId: imageId},
+            {DockerImage.imageName: True, DockerImage.cli_dict: True})
+        if doc is None:
+            return None, None
+        # carry the specs themselves, so that saving the alias stores them
+        # again even if the image they came from is removed meanwhile
+        hashes = set(val[DockerImage.xmlHash]
+                     for val in doc[DockerImage.cli_dict].values()
+                     if DockerImage.xmlHash in val)
+        specs = ModelImporter.model(
+            'cli_xml_spec', 'slicer_cli_web_ssr').getXMLs(hashes)
+        if len(specs) < len(hashes):
+            return None, None
+        cli_dict = {}
+        for (cli, val) in iteritems(doc[DockerImage.cli_dict]):
+            val = dict(val)
+            if DockerImage.xmlHash in val:
+                val[DockerImage.xml] = specs[val.pop(DockerImage.xmlHash)]
+            cli_dict[cli] = val
+        return doc[DockerImage.imageName], cli_dict
+
+    def _externalizeXML(self, docs):
+        """
+        Move the cli xml specs out of image documents and into the
+        cli_xml_spec collection, so that image documents stay small.  The specs
+        of all the documents are stored, or marked as referenced if the
+        documents only hold their hashes, with one bulk write.
+        :param docs: a list of image documents; they are not modified.
+        :returns: a list of copies of the documents in which each cli holds
+            the hash of its xml spec instead of the spec.
+        """
+        specModel = ModelImporter.model('cli_xml_spec', 'slicer_cli_web_ssr')
+        specs = {}
+        referenced = set()
+        results = []
+        for doc in docs:
+            doc = {key: val for (key, val) in iteritems(doc) if key != '_id'}
+            cli_dict = {}
+            for (cli, val) in iteritems(doc[DockerImage.cli_dict]):
+                val = dict(val)
+                if DockerImage.xml in val:
+                    xml = val.pop(DockerImage.xml)
+                    val[DockerImage.xmlHash] = specModel.getHashKey(xml)
+                    specs[val[DockerImage.xmlHash]] = xml
+                referenced.add(val[DockerImage.xmlHash])
+                cli_dict[cli] = val
+            doc[DockerImage.cli_dict] = cli_dict
+            doc[DockerImage.xmlHashes] = sorted(set(
+                val[DockerImage.xmlHash] for val in cli_dict.values()))
+            results.append(doc)
+        # store the specs before the documents that reference them; this also
+        # keeps them from being removed as unreferenced in the meantime
+        specModel.storeXML(specs, referenced)
+        return results
+
+    def _load(self, imgHash, validate=False):
         """
         Attempts to find a specific image in the girder mongo database
         :param imgHash: The hash of the image name used as a key the hash used
          is defined in the DockerImage class
          :type imgHash:string
+        :param validate: documents are validated when they are saved, so they
+            are only validated again when read if this is True.
         :returns:  The DockerImage instance was represented by the hash
         """
         results = super(DockerImageModel, self).findOne(
@@ -151,55 +323,165 @@ class DockerImageModel(AccessControlledModel):
                                            ' %s does not exist in the'
                                            ' database' % imgHash,
                                            None)
-        return DockerImage(results)
+        return DockerImage(results, validate=validate)
 
-    def _getAll(self):
+    def _getAll(self, validate=False):
         """
         Attempt to find all docker image data that was cached in the
-        girder-mongo database
+        girder-mongo database.  Documents saved before the cli xml specs were
+        kept in the cli_xml_spec collection are migrated on the way.
+        :param validate: documents are validated when they are saved, so they
+            are only validated again when read if this is True.
         :returns: a list of DockerImage objects
         """
         results = super(DockerImageModel, self).find()
         img_list = []
 
         for img in results:
-            img_list.append(DockerImage(img))
+            img_list.append(DockerImage(img, validate=validate))
+
+        legacy = [img for img in img_list if img.hasInlineXML()]
+        if legacy:
+            try:
+                migrated = {
+                    doc[DockerImage.imageHash]: DockerImage(doc,
+                                                            validate=False)
+                    for doc in self._writeImages(
+                        [img.getRawData() for img in legacy])}
+            except DockerImageError:
+                # the inline specs are still usable; try again next time
+                logger.warning('Could not move the cli xml specs of %r',
+                               [img.name for img in legacy])
+            else:
+                img_list = [migrated.get(img.hash, img) for img in img_list]
 
         return img_list
 
+    def _writeImages(self, docs):
+        """
+        Validate image documents once and write them in a single bulk upsert
+        keyed on the image hash, after moving their cli xml specs to the
+        cli_xml_spec collection.
+        :param docs: a list of image documents.
+        :returns: the list of documents that were written.
+        """
+        docs = self._externalizeXML(docs)
+        requests = []
+        for doc in docs:
+            self.validate(doc)
+            requests.append(ReplaceOne(
+                {DockerImage.imageHash: doc[DockerImage.imageHash]},
+                doc, upsert=True))
+        try:
+            self.collection.bulk_write(requests, ordered=False)
+        except Exception as err:
+            names = [doc[DockerImage.imageName] for doc in docs]
+            logger.exception('Could not save image metadata for %r', names)
+            raise DockerImageError(
+                'Could not save image metadata to database ' + str(err),
+                names)
+        return docs
+
     def saveAllImgs(self, dockerCache):
         """
         Attempts to same all images in the dockerCache ot the
-        girder-mongo database
+        girder-mongo database.  Each image is validated once and all images
+        are written in a single bulk upsert keyed on the image hash, so
+        saving an image that is already cached replaces its metadata.  A
+        single model.docker_image_model.save_all.after event is triggered
+        with the list of saved documents.
         :param dockerCache: A DockerCache object containing instances of
         DockerImages that are to be cached
         :type dockerCache:DockerCache
         """
         img_list = dockerCache.getImages()
-        for val in img_list:
-            self.save(val)
+        if not img_list:
+            return
+        revision = str(ObjectId())
+        docs = []
+        for img in img_list:
+            doc = dict(img.getRawData())
+            doc[DockerImage.revision] = revision
+            docs.append(doc)
+        docs = self._writeImages(docs)
+        self._bumpVersion()
+        events.trigger('model.%s.save_all.after' % self.name, docs)
+
+    def _bumpVersion(self):
+        """
+        Increment the registry version shared by all girder processes using
+        this database.  Call this after any write to the image metadata, once
+        the write is complete.
+        """
+        self.database[self.name + '_registry'].update_one(
+            {'_id': 'version'}, {'$inc': {'version': 1}}, upsert=True)
 
-    def loadAllImages(self):
+    def acquireLease(self, name, owner, duration):
         """
-        Attempts to generate a DockerCache object with all image metadata
-        stored in girder.If DockerImage metadata is saved in girder but the
-        actual docker image was deleted off the local machine, the metadata
-        will be removed from the mongo database
+        Acquire or renew a lease shared by all girder processes using this
+        database, so that only one of them does some background work.
+        :param name: the name of the lease.
+        :param owner: a string identifying the caller.
+        :param duration: a timedelta after which the lease expires unless it
+            is renewed.
+        :returns: True if the caller holds the lease.
+        """
+        now = datetime.datetime.utcnow()
+        try:
+            self.database[self.name + '_registry'].update_one(
+                {'_id': name, '$or': [{'owner': owner},
+                                      {'expires': {'$lt': now}}]},
+                {'$set': {'owner': owner, 'expires': now + duration}},
+                upsert=True)
+        except DuplicateKeyError:
+            # another owner holds a lease that has not expired
+            return False
+        return True
+
+    def getRegistryVersion(self):
+        """
+        Get the registry version, which changes whenever any girder process
+        writes or removes image metadata.  This is a single small read, so it
+        is cheap to poll.
+        :returns: the registry version as an integer.
+        """
+        doc = self.database[self.name + '_registry'].find_one(
+            {'_id': 'version'})
+        return doc['version'] if doc else 0
+
+    def getDockerCache(self):
+        """
+        Get a DockerCache with all image metadata stored in girder, rebuilt
+        only when the registry version changes.  It must not be modified.
         :returns: A DockerCache object populated with DockerImage objects
         """
-        nonExist = []
-        img_list = self._getAll()
+        version = self.getRegistryVersion()
+        with self._versionLock:
+            if (self._dockerCache is not None and
+                    self._dockerCacheVersion == version):
+                return self._dockerCache
         dockerCache = DockerCache()
-        for img in img_list:
-            try:
-
-                self._ImageExistsLocally(img.name)
-                dockerCache.addImage(img)
-            except DockerImageNotFoundError:
-                nonExist.append(img.name)
-        self.removeImages(nonExist)
+        for img in self._getAll():
+            dockerCache.addImage(img)
+        with self._versionLock:
+            # a write during the rebuild leaves the cache stamped with the old
+            # version so it is rebuilt on the next call
+            self._dockerCache = dockerCache
+            self._dockerCacheVersion = version
         return dockerCache
 
+    def loadAllImages(self):
+        """
+        Attempts to generate a DockerCache object with all image metadata
+        stored in girder.  This is a pure read: metadata of images that were
+        deleted off the local machine is removed in the background by the
+        DockerImageReconciler, not here.
+        :returns: A DockerCache object populated with DockerImage objects.
+            This is the memoized cache from getDockerCache and must not be
+            modified.
+        """
+        return self.getDockerCache()
+
     def delete_docker_image_from_repo(self, name, jobType):
         """
         Creates an asynchronous job to delete the docker images listed in name
@@ -231,33 +513,53 @@ class DockerImageModel(AccessControlledModel):
 
     def removeImages(self, imgList):
         """
-        Attempt to remove image metadata from the mongo database
+        Attempt to remove image metadata from the mongo database.  The images
+        are looked up with a single query and removed with a single delete,
+        so removing many images is one round trip.  Images that are not in
+        the database are reported rather than stopping the removal of the
+        others.  A single model.docker_image_model.remove_all.after event is
+        triggered with the list of removed names.
         :param imgList: a list of docker image names
         :type imgList: a list of strings
-
+        :returns: a list of the image names that were not in the database.
         """
+        hashes = {DockerImage.getHashKey(img): img for img in imgList}
+        if not hashes:
+            return []
         try:
-            for img in imgList:
-                hash = DockerImage.getHashKey(img)
-                imageData = self._load(hash)
-                super(DockerImageModel, self).remove(imageData.getRawData())
+            found = set()
+            xmlHashes = []
+            for doc in self.collection.find(
+                    {DockerImage.imageHash: {'$in': list(hashes)}},
+                    {DockerImage.imageHash: True, DockerImage.xmlHashes: True}):
+                found.add(doc[DockerImage.imageHash])
+                xmlHashes.extend(doc.get(DockerImage.xmlHashes, []))
+            if found:
+                self.collection.delete_many(
+                    {DockerImage.imageHash: {'$in': list(found)}})
+                self._bumpVersion()
+                ModelImporter.model(
+                    'cli_xml_spec', 'slicer_cli_web_ssr').removeUnreferenced(
+                    xmlHashes)
         except Exception as err:
-            if isinstance(err, DockerImageNotFoundError):
-                logger.exception('Image %r does not exist', img)
-                raise DockerImageNotFoundError(
-                    'The image %s with hash %s does not exist '
-                    'in the database' % (img, hash), img)
-            else:
-                logger.exception('Could not remove image %r', img)
-                raise DockerImageError(
-                    'Could not delete the image data from the database '
-                    'invalid image: ' + img + ' ' + str(err), img)
+            logger.exception('Could not remove images %r', imgList)
+            raise DockerImageError(
+                'Could not delete the image data from the database ' +
+                str(err), list(imgList))
+        notFound = [img for (hash, img) in iteritems(hashes)
+                    if hash not in found]
+        for img in notFound:
+            logger.info('Image %r does not exist', img)
+        if found:
+            events.trigger('model.%s.remove_all.after' % self.name,
+                           [hashes[hash] for hash in found])
+        return notFound
 
     # TODO validate the xml of each cli
     def validate(self, doc):
         try:
             # validate structure of cached data on docker image
-            jsonschema.validate(doc, DockerImageStructure.ImageSchema)
+            DockerImageStructure.validator.validate(doc)
             # check cli xml is correct
             #
             # loc=os.path.dirname(os.path.abspath(__file__))+'/ModuleDescription.xsd'
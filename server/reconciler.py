@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import datetime
+import threading
+import time
+
+import docker
+from bson.objectid import ObjectId
+
+from girder import logger
+from girder.models.model_base import ModelImporter
+
+from .constants import PluginSettings
+from .docker_client import getDockerClient, LocalImageIndex
+
+# image events that can change which images are available locally
+_IMAGE_ACTIONS = ('delete', 'untag', 'tag', 'pull', 'load', 'import')
+
+
+class DockerImageReconciler(object):
+    """
+    Removes registered images that are no longer local and refreshes those
+    whose tag moved, after docker image events and periodically.
+    """
+
+    def __init__(self, resource, interval=None, debounce=2.0):
+        """
+        :param resource: the DockerResource whose endpoints are maintained.
+        :param interval: the number of seconds between full sweeps.  If None,
+            the slicer_cli_web_ssr.reconcile_interval setting is used.
+        :param debounce: the number of seconds to wait after an event before
+            reconciling, so that a burst of events is handled at once.
+        """
+        self.resource = resource
+        self.interval = interval
+        self.debounce = debounce
+        self._stop = threading.Event()
+        self._pending = threading.Event()
+        self._events = None
+        # identifies this reconciler in the lease shared by girder processes
+        self._owner = str(ObjectId())
+        # {image name: time} of the refreshes this reconciler scheduled
+        self._refreshed = {}
+
+    def start(self):
+        if self.interval is None:
+            self.interval = float(ModelImporter.model('setting').get(
+                PluginSettings.RECONCILE_INTERVAL))
+        # reconcile once at startup to catch changes made while the server
+        # was not running
+        self._pending.set()
+        for target in (self._watchEvents, self._reconcileLoop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._pending.set()
+        if self._events is not None:
+            try:
+                self._events.close()
+            except Exception:
+                pass
+
+    def _watchEvents(self):
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                self._events = getDockerClient().events(
+                    decode=True, filters={'type': 'image'})
+                backoff = 1
+                for event in self._events:
+                    if self._stop.is_set():
+                        break
+                    action = event.get('Action') or event.get('status')
+                    if action in _IMAGE_ACTIONS:
+                        self._pending.set()
+            except Exception:
+                logger.exception('Lost the docker event stream')
+            if not self._stop.is_set():
+                # anything could have happened while we were not listening
+                self._pending.set()
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60)
+
+    def _reconcileLoop(self):
+        while not self._stop.is_set():
+            self._pending.wait(self.interval)
+            if self._stop.is_set():
+                break
+            self._stop.wait(self.debounce)
+            self._pending.clear()
+            try:
+                self.reconcile()
+            except Exception:
+                logger.exception('Failed to reconcile docker images')
+
+    def reconcile(self):
+        """
+        Compare the registered images with the local images once, if this
+        girder process holds the reconciler lease.
+
+        :returns: a tuple of the list of image names that were removed and the
+            list of image names that were scheduled to be refreshed.
+        """
+        imageModel = ModelImporter.model('docker_image_model',
+                                         'slicer_cli_web_ssr')
+        interval = self.interval or 0
+        if not imageModel.acquireLease(
+                'reconciler', self._owner,
+                datetime.timedelta(seconds=3 * interval + 60)):
+            return [], []
+        try:
+            client = getDockerClient()
+            localImages = LocalImageIndex(client)
+        except Exception:
+            logger.exception('Could not list the local docker images')
+            return [], []
+        missing = []
+        moved = []
+        for img in imageModel.getDockerCache().getImages():
+            imageId = localImages.getImageId(img.name)
+            if imageId is None:
+                # only remove images docker itself reports as missing
+                try:
+                    imageId = client.images.get(img.name).id
+                except docker.errors.ImageNotFound:
+                    missing.append(img.name)
+                    continue
+            if img.getImageId() is not None and imageId != img.getImageId():
+                moved.append(img.name)
+        if missing:
+            logger.info('Removing docker images that are no longer local: %r',
+                        missing)
+            imageModel.removeImages(missing)
+            self.resource.deleteImageEndpoints(missing)
+        # a refresh that is running or that was scheduled within the last
+        # sweep interval, and may have failed, is not scheduled again
+        now = time.time()
+        self._refreshed = {name: when for (name, when) in
+                           self._refreshed.items() if now - when < interval}
+        _, covered = imageModel.findActiveIngestJobs(
+            moved, self.resource.jobType, ('jobPullAndLoad', 'jobRefresh'))
+        moved = [name for name in moved
+                 if name not in covered and name not in self._refreshed]
+        if moved:
+            logger.info('Refreshing docker images whose tag moved: %r', moved)
+            imageModel.refreshImages(moved, self.resource.jobType)
+            self._refreshed.update((name, now) for name in moved)
+        # specs that were still in their grace period when their last image
+        # was removed
+        ModelImporter.model('cli_xml_spec',
+                            'slicer_cli_web_ssr').removeUnreferenced()
+        return missing, moved
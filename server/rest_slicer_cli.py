@@ -1,9 +1,11 @@
 import os
 import sys
 import json
+import functools
 import six
-import subprocess
-import tempfile
+import io
+
+import docker
 
 from ctk_cli import CLIModule
 from girder.api.rest import Resource, loadmodel, boundHandler, \
@@ -17,6 +19,11 @@ from girder.plugins.worker import constants
 from girder import logger
 from girder.models.group import Group
 
+from .docker_client import getDockerClient
+from .image_job import getDockerOutput
+from .cli_parse_cache import getCLIParseCache
+from .models import CliXmlSpec, DockerImageError
+
 _SLICER_TO_GIRDER_WORKER_TYPE_MAP = {
     'boolean': 'boolean',
     'integer': 'integer',
@@ -101,6 +108,22 @@ def _getCLIParameters(clim):
     return index_params, opt_params, simple_out_params
 
 
+def _parseCLIXML(cliXML):
+    """Parse a CLI xml spec from memory.
+
+    Returns
+    -------
+    tuple
+        the CLIModule and the index, optional and simple output parameters
+        from _getCLIParameters
+
+    """
+    if isinstance(cliXML, six.text_type):
+        cliXML = cliXML.encode('utf8')
+    clim = CLIModule(stream=io.BytesIO(cliXML))
+    return (clim,) + _getCLIParameters(clim)
+
+
 def _createIndexedParamTaskSpec(param):
     """Creates task spec for indexed parameters
 
@@ -646,7 +669,8 @@ def _addIndexedParamsToContainerArgs(index_params, containerArgs, hargs):
         containerArgs.append(curValue)
 
 
-def genHandlerToRunDockerCLI(dockerImage, cliRelPath, cliXML, restResource): # noqa
+def genHandlerToRunDockerCLI(dockerImage, cliRelPath, cliXML, restResource, # noqa
+                             xmlHash=None):
     """Generates a handler to run docker CLI using girder_worker
 
     Parameters
@@ -656,11 +680,16 @@ def genHandlerToRunDockerCLI(dockerImage, cliRelPath, cliXML, restResource): # n
     cliRelPath : str
         Relative path of the CLI which is needed to run the CLI by running
         the command docker run `dockerImage` `cliRelPath`
-    cliXML:str
-        Cached copy of xml spec for this cli
+    cliXML:str or function
+        Cached copy of xml spec for this cli, or a function without arguments
+        that returns it
     restResource : girder.api.rest.Resource
         The object of a class derived from girder.api.rest.Resource to which
         this handler will be attached
+    xmlHash : str, optional
+        The content hash of the xml spec.  Parse results are memoized by this
+        hash, so if it is given and the spec was parsed before, the spec is
+        neither loaded nor parsed.
 
     Returns
     -------
@@ -672,12 +701,12 @@ def genHandlerToRunDockerCLI(dockerImage, cliRelPath, cliXML, restResource): # n
     cliName = os.path.normpath(cliRelPath).replace(os.sep, '.')
 
     # get xml spec
-    str_xml = cliXML
-    # parse cli xml spec
-    with tempfile.NamedTemporaryFile(suffix='.xml') as f:
-        f.write(str_xml)
-        f.flush()
-        clim = CLIModule(f.name)
+    loadXML = cliXML if callable(cliXML) else (lambda: cliXML)
+    if xmlHash is None:
+        xmlHash = CliXmlSpec.getHashKey(loadXML())
+    # parse cli xml spec and get CLI parameters
+    clim, index_params, opt_params, simple_out_params = \
+        getCLIParseCache().get(xmlHash, loadXML, _parseCLIXML)
 
     # create CLI description string
     str_description = ['Description: <br/><br/>' + clim.description]
@@ -702,9 +731,6 @@ def genHandlerToRunDockerCLI(dockerImage, cliRelPath, cliXML, restResource): # n
     handlerDesc = Description(clim.title).notes(str_description)
 
     # print handlerDesc
-    # get CLI parameters
-    index_params, opt_params, simple_out_params = _getCLIParameters(clim)
-
     # print index_params [<CLIParameter 'inputMultipleImage' of type directory>,
     # <CLIParameter 'outputThresholding' of type file>, <CLIParameter 'tableFile' of type file>]
     # add indexed input parameters
@@ -886,6 +912,43 @@ def genHandlerToRunDockerCLI(dockerImage, cliRelPath, cliXML, restResource): # n
     return handlerFunc
 
 
+def parseCLIsInDockerCache(dockerCache):
+    """Parse the xml specs of all CLIs of the images in a docker cache that
+    have not been parsed yet, reading the specs with one query, so that
+    generating their end points afterwards finds every spec in the parse
+    cache.  No end points are created.
+
+    Parameters
+    ----------
+    dockerCache : DockerCache object representing data stored in settings
+
+    Returns
+    -------
+    int
+        the number of specs that were parsed
+
+    """
+    parseCache = getCLIParseCache()
+    clis = {}
+    for docker_image in dockerCache.getImages():
+        for cliRelPath in docker_image.getCLIListSpec():
+            xmlHash = docker_image.getCLIXMLHash(cliRelPath)
+            if xmlHash not in parseCache:
+                clis.setdefault(xmlHash, (docker_image, cliRelPath))
+    if not clis:
+        return 0
+    specs = ModelImporter.model('cli_xml_spec', 'slicer_cli_web_ssr').getXMLs(
+        list(clis))
+    for (xmlHash, (docker_image, cliRelPath)) in six.iteritems(clis):
+        if xmlHash not in specs:
+            try:
+                specs[xmlHash] = docker_image.getCLIXML(cliRelPath)
+            except Exception:
+                logger.exception('Could not get the xml spec of %s',
+                                 cliRelPath)
+    return parseCache.parseMany(specs, _parseCLIXML)
+
+
 def genHandlerToGetDockerCLIXmlSpec(cliRelPath, cliXML, restResource):
     """Generates a handler that returns the XML spec of the docker CLI
 
@@ -896,8 +959,10 @@ def genHandlerToGetDockerCLIXmlSpec(cliRelPath, cliXML, restResource):
     cliRelPath : str
         Relative path of the CLI which is needed to run the CLI by running
         the command docker run `dockerImage` `cliRelPath`
-    cliXML: str
-        value of clispec stored in settings
+    cliXML: str or function
+        value of clispec stored in settings, or a function without arguments
+        that returns it.  A function is called on each request, so the spec
+        is not held in memory by the handler.
     restResource : girder.api.rest.Resource
         The object of a class derived from girder.api.rest.Resource to which
         this handler will be attached
@@ -909,9 +974,11 @@ def genHandlerToGetDockerCLIXmlSpec(cliRelPath, cliXML, restResource):
 
     """
 
-    str_xml = cliXML
-    if isinstance(str_xml, six.text_type):
-        str_xml = str_xml.encode('utf8')
+    def getXML():
+        str_xml = cliXML() if callable(cliXML) else cliXML
+        if isinstance(str_xml, six.text_type):
+            str_xml = str_xml.encode('utf8')
+        return str_xml
 
     # define the handler that returns the CLI's xml spec
     @boundHandler(restResource)
@@ -922,7 +989,7 @@ def genHandlerToGetDockerCLIXmlSpec(cliRelPath, cliXML, restResource):
     def getXMLSpecHandler(self, *args, **kwargs):
         setResponseHeader('Content-Type', 'application/xml')
         setRawResponse()
-        return str_xml
+        return getXML()
 
     return getXMLSpecHandler
 
@@ -1056,7 +1123,103 @@ def genRESTEndPointsForSlicerCLIsInDocker(info, restResource, dockerImages):
     return restResource
 
 
-def genRESTEndPointsForSlicerCLIsInDockerCache(restResource, dockerCache): # noqa
+def getImageRestPath(dimg):
+    """Get the route component used for a docker image in the CLI routes.
+    The characters of docker image names that cannot be used in a route are
+    replaced with '_'.
+    """
+    return dimg.replace(':', '_').replace('/', '_').replace('@', '_')
+
+
+def resourceServesImage(restResource, dimg):
+    """Check whether a REST resource serves the CLIs of a docker image.  A
+    resource other than the default one only serves the images whose tag
+    matches its name.
+    """
+    return (restResource.resourceName == 'slicer_cli_web_ssr' or
+            restResource.resourceName == dimg[dimg.find(':')+1:])
+
+
+def genRESTEndPointsForSlicerCLI(restResource, dimg, docker_image, cliRelPath):
+    """Generates the REST end points of one CLI of a docker image and
+    attaches them to a REST resource.
+
+    Parameters
+    ----------
+    restResource : a dockerResource
+        REST resource to which the end-points should be attached
+    dimg : str
+        the docker image name
+    docker_image : DockerImage object of the image
+    cliRelPath : str
+        the name of the CLI
+
+    Returns
+    -------
+    bool
+        True if the end points were created.
+
+    """
+    restPath = getImageRestPath(dimg)
+    # create a POST REST route that runs the CLI
+    try:
+        cliRunHandler = genHandlerToRunDockerCLI(
+            dimg,
+            cliRelPath,
+            functools.partial(docker_image.getCLIXML, cliRelPath),
+            restResource,
+            docker_image.getCLIXMLHash(cliRelPath))
+
+    except Exception:
+        logger.exception('Failed to create REST endpoints for %r',
+                         cliRelPath)
+        return False
+
+    cliSuffix = os.path.normpath(cliRelPath).replace(os.sep, '_')
+
+    cliRunHandlerName = restPath+'_run_' + cliSuffix
+    setattr(restResource, cliRunHandlerName, cliRunHandler)
+    restResource.route('POST',
+                       (restPath, cliRelPath, 'run'),
+                       getattr(restResource, cliRunHandlerName))
+
+    # store new rest endpoint
+    restResource.storeEndpoints(
+        dimg, cliRelPath, 'run', ['POST', (restPath, cliRelPath, 'run'),
+                                  cliRunHandlerName])
+
+    # create GET REST route that returns the xml of the CLI
+    try:
+        cliGetXMLSpecHandler = genHandlerToGetDockerCLIXmlSpec(
+            cliRelPath,
+            functools.partial(docker_image.getCLIXML, cliRelPath),
+            restResource)
+    except Exception:
+        logger.exception('Failed to create REST endpoints for %s',
+                         cliRelPath)
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+        logger.error('%r', [exc_type, fname, exc_tb.tb_lineno])
+        return False
+
+    cliGetXMLSpecHandlerName = restPath+'_get_xml_' + cliSuffix
+    setattr(restResource,
+            cliGetXMLSpecHandlerName,
+            cliGetXMLSpecHandler)
+    restResource.route('GET',
+                       (restPath, cliRelPath, 'xmlspec',),
+                       getattr(restResource, cliGetXMLSpecHandlerName))
+
+    restResource.storeEndpoints(
+        dimg, cliRelPath, 'xmlspec',
+        ['GET', (restPath, cliRelPath, 'xmlspec'),
+         cliGetXMLSpecHandlerName])
+    logger.debug('Created REST endpoints for %s', cliRelPath)
+    return True
+
+
+def genRESTEndPointsForSlicerCLIsInDockerCache(restResource, dockerCache,
+                                               clis=None):
     """Generates REST end points for slicer CLIs placed in subdirectories of a
     given root directory and attaches them to a REST resource with the given
     name.
@@ -1075,148 +1238,31 @@ def genRESTEndPointsForSlicerCLIsInDockerCache(restResource, dockerCache): # noq
     restResource : a dockerResource
         REST resource to which the end-points should be attached
     dockerCache : DockerCache object representing data stored in settings
+    clis : dict, optional
+        if given, a dictionary of {image name: list of CLI names}; only the
+        end points of those CLIs are created.
 
     """
 
     dockerImages = dockerCache.getImageNames()
-    # print '------resourceName is-------'
-    # print restResource.resourceName
     # validate restResource argument
     if not isinstance(restResource, Resource):
         raise Exception('restResource must be a '
                         'Docker Resource')
 
     for dimg in dockerImages:
-        # print '------tag is-------'
-        # print dimg[dimg.find(':')+1:]
-        if restResource.resourceName != 'slicer_cli_web_ssr':
-            if restResource.resourceName == dimg[dimg.find(':')+1:]:
-                # print 'register Images',dimg[:dimg.find(':')],'in',restResource.resourceName
-                docker_image = dockerCache.getImageByName(dimg)
-                # get CLI list
-                cliListSpec = docker_image.getCLIListSpec()
-
-                # Add REST end-point for each CLI
-                for cliRelPath in cliListSpec.keys():
-                    restPath = dimg.replace(
-                        ':', '_').replace('/', '_').replace('@', '_')
-                    # create a POST REST route that runs the CLI
-                    try:
-                        cliXML = docker_image.getCLIXML(cliRelPath)
-
-                        cliRunHandler = genHandlerToRunDockerCLI(dimg,
-                                                                 cliRelPath,
-                                                                 cliXML,
-                                                                 restResource)
-
-                    except Exception:
-                        logger.exception('Failed to create REST endpoints for %r',
-                                         cliRelPath)
-                        continue
-
-                    cliSuffix = os.path.normpath(cliRelPath).replace(os.sep, '_')
-
-                    cliRunHandlerName = restPath+'_run_' + cliSuffix
-                    setattr(restResource, cliRunHandlerName, cliRunHandler)
-                    restResource.route('POST',
-                                       (restPath, cliRelPath, 'run'),
-                                       getattr(restResource, cliRunHandlerName))
-
-                    # store new rest endpoint
-                    restResource.storeEndpoints(
-                        dimg, cliRelPath, 'run', ['POST', (restPath, cliRelPath, 'run'),
-                                                  cliRunHandlerName])
-
-                    # create GET REST route that returns the xml of the CLI
-                    try:
-                        cliGetXMLSpecHandler = genHandlerToGetDockerCLIXmlSpec(
-                            cliRelPath, cliXML,
-                            restResource)
-                    except Exception:
-                        logger.exception('Failed to create REST endpoints for %s',
-                                         cliRelPath)
-                        exc_type, exc_obj, exc_tb = sys.exc_info()
-                        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                        logger.error('%r', [exc_type, fname, exc_tb.tb_lineno])
-                        continue
-
-                    cliGetXMLSpecHandlerName = restPath+'_get_xml_' + cliSuffix
-                    setattr(restResource,
-                            cliGetXMLSpecHandlerName,
-                            cliGetXMLSpecHandler)
-                    restResource.route('GET',
-                                       (restPath, cliRelPath, 'xmlspec',),
-                                       getattr(restResource, cliGetXMLSpecHandlerName))
-
-                    restResource.storeEndpoints(
-                        dimg, cliRelPath, 'xmlspec',
-                        ['GET', (restPath, cliRelPath, 'xmlspec'),
-                         cliGetXMLSpecHandlerName])
-                    logger.debug('Created REST endpoints for %s', cliRelPath)
+        if not resourceServesImage(restResource, dimg):
+            continue
+        docker_image = dockerCache.getImageByName(dimg)
+        # get CLI list
+        cliListSpec = docker_image.getCLIListSpec()
 
-        else:
-            # print 'register all in',restResource.resourceName
-            docker_image = dockerCache.getImageByName(dimg)
-            # get CLI list
-            cliListSpec = docker_image.getCLIListSpec()
-
-            # Add REST end-point for each CLI
-            for cliRelPath in cliListSpec.keys():
-                restPath = dimg.replace(
-                    ':', '_').replace('/', '_').replace('@', '_')
-                # create a POST REST route that runs the CLI
-                try:
-                    cliXML = docker_image.getCLIXML(cliRelPath)
-
-                    cliRunHandler = genHandlerToRunDockerCLI(dimg,
-                                                             cliRelPath,
-                                                             cliXML,
-                                                             restResource)
-
-                except Exception:
-                    logger.exception('Failed to create REST endpoints for %r',
-                                     cliRelPath)
-                    continue
-
-                cliSuffix = os.path.normpath(cliRelPath).replace(os.sep, '_')
-
-                cliRunHandlerName = restPath+'_run_' + cliSuffix
-                setattr(restResource, cliRunHandlerName, cliRunHandler)
-                restResource.route('POST',
-                                   (restPath, cliRelPath, 'run'),
-                                   getattr(restResource, cliRunHandlerName))
-
-                # store new rest endpoint
-                restResource.storeEndpoints(
-                    dimg, cliRelPath, 'run', ['POST', (restPath, cliRelPath, 'run'),
-                                              cliRunHandlerName])
-
-                # create GET REST route that returns the xml of the CLI
-                try:
-                    cliGetXMLSpecHandler = genHandlerToGetDockerCLIXmlSpec(
-                        cliRelPath, cliXML,
-                        restResource)
-                except Exception:
-                    logger.exception('Failed to create REST endpoints for %s',
-                                     cliRelPath)
-                    exc_type, exc_obj, exc_tb = sys.exc_info()
-                    fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                    logger.error('%r', [exc_type, fname, exc_tb.tb_lineno])
-                    continue
-
-                cliGetXMLSpecHandlerName = restPath+'_get_xml_' + cliSuffix
-                setattr(restResource,
-                        cliGetXMLSpecHandlerName,
-                        cliGetXMLSpecHandler)
-                restResource.route('GET',
-                                   (restPath, cliRelPath, 'xmlspec',),
-                                   getattr(restResource, cliGetXMLSpecHandlerName))
-
-                restResource.storeEndpoints(
-                    dimg, cliRelPath, 'xmlspec',
-                    ['GET', (restPath, cliRelPath, 'xmlspec'),
-                     cliGetXMLSpecHandlerName])
-                logger.debug('Created REST endpoints for %s', cliRelPath)
+        # Add REST end-point for each CLI
+        for cliRelPath in cliListSpec.keys():
+            if clis is not None and cliRelPath not in clis.get(dimg, ()):
+                continue
+            genRESTEndPointsForSlicerCLI(restResource, dimg, docker_image,
+                                         cliRelPath)
 
     return restResource
 
@@ -1232,13 +1278,8 @@ def getDockerImage(imageName, pullIfNotExist=False):
     None is returned
     """
     try:
-        # docker inspect returns non zero if the image is not available
-        # locally
-        data = subprocess.check_output(['docker', 'inspect',
-                                        '--format="{{json .Id}}"', imageName])
-
-        return data
-    except subprocess.CalledProcessError:
+        return getDockerClient().images.get(imageName).id
+    except docker.errors.ImageNotFound:
         if pullIfNotExist:
             # the image does not exist locally, try to pull from dockerhub
             # none is returned if it fails
@@ -1263,13 +1304,8 @@ def getDockerImageCLIList(imageName):
     }
     """
     try:
-        # docker inspect returns non zero if the image is not available
-        # locally
-        data = subprocess.check_output(
-            ['docker', 'run', '--rm', imageName, '--list_cli'])
-        return data
-    except subprocess.CalledProcessError:
-        # the image does not exist locally, try to pull from dockerhub
+        return getDockerOutput(imageName, '--list_cli', getDockerClient())
+    except DockerImageError:
         raise Exception("Could not get the cli list for the img %s most "
                         "likely the docker image entrypoint does "
                         "not accept the argument --list_cli" % imageName)
@@ -1281,20 +1317,18 @@ def getDockerImageCLIXMLSpec(img, cli):
 
     """
     try:
-        data = subprocess.check_output(['docker', 'run', '--rm', img, cli, '--xml'])
-        return data
-    except subprocess.CalledProcessError:
-        # the image does not exist locally, try to pull from dockerhub
+        return getDockerOutput(img, '%s --xml' % cli, getDockerClient())
+    except DockerImageError:
         raise Exception('Could not get xml data for img %s '
                         'cli %s' % (img, cli))
 
 
 def pullDockerImage(img):
     try:
-        subprocess.check_output(['docker', 'pull', img])
+        getDockerClient().images.pull(img)
         data = getDockerImage(img)
         return data
-    except subprocess.CalledProcessError:
+    except docker.errors.APIError:
         # the image does not exist on the default repository
 
         return None
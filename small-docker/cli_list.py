@@ -4,6 +4,33 @@ import sys
 import subprocess
 
 
+def addXMLToListSpec(list_spec):
+    # Add the xml spec of each cli, preferring <cli>/<cli>.xml over running
+    # <cli> --xml.  Clis without an xml spec are left as they are.
+    for cli in list_spec:
+        cli_path = os.path.normpath(cli)
+        xml_file = os.path.join(cli_path, os.path.basename(cli_path) + '.xml')
+        try:
+            if os.path.isfile(xml_file):
+                with open(xml_file, 'rt') as f:
+                    xml = f.read()
+            elif list_spec[cli]['type'] == 'python':
+                xml = subprocess.check_output([
+                    sys.executable,
+                    os.path.join(cli_path, os.path.basename(cli_path) + '.py'),
+                    '--xml'])
+            else:
+                xml = subprocess.check_output([
+                    os.path.join('.', cli_path, os.path.basename(cli_path)),
+                    '--xml'])
+            if isinstance(xml, bytes):
+                xml = xml.decode('utf8')
+            list_spec[cli]['xml'] = xml
+        except Exception:
+            pass
+    return list_spec
+
+
 def processCLI(filename):
     try:
         with open(os.path.join(os.path.dirname(os.path.realpath(__file__)),
@@ -13,6 +40,8 @@ def processCLI(filename):
         print('Failed to parse %s' % filename)
         return
     if len(sys.argv) >= 2 and sys.argv[1] == '--list_cli':
+        if '--with-xml' in sys.argv[2:]:
+            list_spec = addXMLToListSpec(list_spec)
         print(json.dumps(list_spec, sort_keys=True, indent=2, separators=(',', ': ')))
         return
     if len(sys.argv) < 2 or sys.argv[1][:1] == '-':